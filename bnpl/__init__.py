@@ -1,7 +1,7 @@
-from bnpl.core import Config, Sound
+from bnpl.core import Config, Sound, SoundBatch
 from bnpl.plugin import (
 	Plugin, Option, OptionSet,
-	Extractor, Transformer, Importer, Exporter,
+	Extractor, Transformer, Importer, Exporter, Filter, Command,
 	Factory
 )
 
@@ -1,11 +1,13 @@
 """
 # API SPEC:
 # GET /sounds - search for sounds
+# GET /sounds/facets - bucket counts for sounds matching a filter
 # POST /sounds - upsert sounds
 # DELETE /sounds - delete sounds by query
 # GET /sounds/:uid - fetch a sound 
 # POST /sounds/:uid - upsert a sound by it's id
 # DELETE /sounds/:uid - delete a sound by it's id
+# GET /metrics - cache counters
 # GET/POST /sounds/:uid/transform/:transform - apply a transformation to a sound, yielding one or more sounds.
 """
 
@@ -14,6 +16,8 @@ from flask import Flask
 from bnpl import util
 from bnpl import Factory
 from bnpl.plugin import Extractor, Importer, Deleter
+from bnpl.plugin_elastic import Facets
+from bnpl.core import Sound, ElasticStore, S3Store, get_client
 
 app = Flask(__name__)
 plugins = Factory()
@@ -40,11 +44,24 @@ def delete_sounds():
   return Deleter(_context="api").do()
 
 
+@app.route('/api/sounds/facets', methods=['GET'])
+def sound_facets():
+  """
+  """
+  return Facets(_context="api").do()
+
+
 @app.route('/api/sounds/<uid>.<ext>', methods=['GET'])
 def get_sound(uid, ext):
   """
   """
-  return Extractor(_context="api").do()
+  from elasticsearch import NotFoundError
+  db = get_client('db', ElasticStore)
+  try:
+    sound = db.get(Sound.from_store({'uid': uid, 'ext': ext}))
+  except NotFoundError:
+    return util.api_write_data({'error': 'No sound {0}.{1}'.format(uid, ext)}, status=404)
+  return util.api_write_data(sound)
 
 
 @app.route('/api/sounds/<uid>', methods=['POST', 'PUT', 'PATCH'])
@@ -82,5 +99,14 @@ def run_plugin(name):
   return p(_context="api").do()
 
 
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+  """
+  """
+  cache = get_client('db', ElasticStore).cache_stats()
+  cache['files'] = get_client('fs', S3Store).cache.stats()
+  return util.api_write_data({'cache': cache})
+
+
 if __name__ == '__main__':
   app.run()
\ No newline at end of file
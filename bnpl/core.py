@@ -2,27 +2,187 @@ from datetime import datetime
 import json
 import csv
 import os
+import re
+import logging
 from StringIO import StringIO
 import tempfile
 import copy
-
-import s3plz
+import base64
+import hashlib
+import itertools
+import time
+import threading
+import signal
+import socket
+import contextlib
+import array
+from functools import partial
+from collections import OrderedDict, Counter
+
+import gevent
 from unidecode import unidecode
-from elasticsearch import Elasticsearch
 
 from bnpl import util
+from bnpl.exc import StoreError
 
 
 Config = util.sys_get_config(os.getenv('BNPL_CONFIG', util.path_here(__file__, 'config/')))
 
+# s3 won't accept multipart uploads with parts under 5mb.
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+S3_PART_SIZE = 8 * 1024 * 1024
+
+CACHE_SIZE = 5 * 1024 * 1024 * 1024
+
+# bulk requests to elasticsearch.
+ES_BULK_SIZE = 500
+ES_BULK_MAX_BYTES = 10 * 1024 * 1024
+ES_RETRY_STATUSES = (429, 502, 503, 504)
+
+# facet aggregations, by name.
+ES_FACETS = {
+  'key': {'terms': {'field': 'properties.key', 'size': 24}},
+  'chord': {'terms': {'field': 'properties.chord', 'size': 24}},
+  'genre': {'terms': {'field': 'properties.genre', 'size': 50}},
+  'ext': {'terms': {'field': 'ext', 'size': 20}},
+  'bpm': {'histogram': {'field': 'properties.bpm', 'interval': 5, 'min_doc_count': 1}},
+  'duration': {'range': {'field': 'properties.duration', 'ranges': [
+    {'key': 'short', 'to': 60},
+    {'key': 'medium', 'from': 60, 'to': 300},
+    {'key': 'long', 'from': 300, 'to': 900},
+    {'key': 'extended', 'from': 900}
+  ]}}
+}
+
+# index settings while in bulk mode.
+ES_BULK_SETTINGS = {'refresh_interval': '-1', 'number_of_replicas': 0}
+
+# compression per mimetype / extension. audio that's already
+# compressed gains almost nothing from another pass.
+COMPRESSION_POLICY = {
+  'mp3': None,
+  'm4a': None,
+  'aac': None,
+  'flac': None,
+  'ogg': None,
+  'wma': None,
+  'audio/mpeg': None,
+  'audio/m4a': None,
+  'audio/aac': None,
+  'audio/flac': None,
+  'audio/x-flac': None,
+  'audio/ogg': None,
+  'audio/x-ms-wma': None,
+  'wav': 'gz:6',
+  'aif': 'gz:6',
+  'aiff': 'gz:6',
+  'audio/wav': 'gz:6',
+  'audio/aiff': 'gz:6',
+  'audio/x-aiff': 'gz:6'
+}
+
 
 # configurations mixin.
 class ConfigMixin(object):
   """
   """
+  __slots__ = ()
   config = Config
 
 
+# per-process clients.
+_clients = {}
+
+def get_client(name, connect):
+  """
+  Create a client on first use and cache it for this process,
+  so forked workers each build their own connection pool.
+  """
+  pid = os.getpid()
+  key = (pid, name)
+  client = _clients.get(key)
+  if client is None:
+    # drop anything inherited from a parent process.
+    for k in [k for k in _clients if k[0] != pid]:
+      del _clients[k]
+    client = _clients[key] = connect()
+  return client
+
+
+# top-level fields of a sound; anything else lives under `properties`.
+SOUND_FIELDS = (
+  'uid', 'path', 'ext', 'mimetype', 'slug', 
+  'filename', 'url', 'created_at', 'updated_at'
+)
+
+# fields Sound computes, never read back from the store.
+DERIVED_FIELDS = ('slug', 'filename', 'url')
+
+# fields a sound can't be built without.
+SOURCE_REQUIRED = ('uid', 'path', 'ext')
+
+
+def filter_to_query(s):
+  """
+  Compile a filter string into an elasticsearch query.
+  """
+  return copy.deepcopy(_filter_compile(util.filter_normalize(s)))
+
+@util.exec_memoize(size=512)
+def _filter_compile(s):
+  """
+  compile a normalized filter string.
+  """
+  f = util.filter_parse(s)
+  clauses = [_filter_clause(c) for c in f['filter']]
+  if not clauses:
+    query = {'match_all': {}}
+  elif f['compare'] == 'or':
+    query = {'bool': {'should': clauses, 'minimum_should_match': 1}}
+  else:
+    query = {'bool': {'filter': clauses}}
+  return {
+    'query': query,
+    'sort': [{_filter_field(o['key']): {'order': o['op']}} for o in f['order']]
+  }
+
+def _filter_clause(c):
+  """
+  compile a single filter.
+  """
+  field = _filter_field(c['key'])
+  op, val = c['op'], c['val']
+
+  # multiple values
+  if isinstance(val, dict):
+    if op == 'eq' and val['compare'] == 'or':
+      return {'terms': {field: val['items']}}
+    clauses = [_filter_clause(dict(c, val=v)) for v in val['items']]
+    if val['compare'] == 'or':
+      return {'bool': {'should': clauses, 'minimum_should_match': 1}}
+    return {'bool': {'filter': clauses}}
+
+  if op == 'eq':
+    return {'term': {field: val}}
+  if op == 'ne':
+    return {'bool': {'must_not': [{'term': {field: val}}]}}
+  if op in ('gt', 'gte', 'lt', 'lte'):
+    return {'range': {field: {op: val}}}
+  if op == 'regex':
+    return {'regexp': {field: val}}
+  if op == 'query':
+    return {'match': {field: val}}
+  raise ValueError('Invalid filter operator: {0}'.format(op))
+
+def _filter_field(key):
+  """
+  map a filter key to a document field.
+  """
+  if key.split('.')[0] in SOUND_FIELDS or key.startswith('properties.'):
+    return key
+  return u'properties.{0}'.format(key)
+
+
 # core storage object
 class Store(ConfigMixin):
 
@@ -63,97 +223,856 @@ class Store(ConfigMixin):
     raise NotImplemented
 
 
+class S3Index(ConfigMixin):
+  """
+  An index of the blobs under `file_dir`, built from a single prefix 
+  listing and cached on disk for `file_index_ttl` seconds so that 
+  existence checks don't each cost a HEAD request. Uploads / deletes
+  made while the index is live are appended to it.
+  """
+
+  def __init__(self, store):
+    self.store = store
+    self._keys = None
+    self._built_at = 0
+    self._lock = threading.Lock()
+
+  @property
+  def ttl(self):
+    """
+    seconds before the index is rebuilt. 0 disables the index.
+    """
+    return self.config['bnpl'].get('file_index_ttl', 3600)
+
+  @property
+  def path(self):
+    """
+    local cache of the index.
+    """
+    return "{0}/bnpl-index-{1}.txt".format(self.config['bnpl'].get('tmp_dir', '/tmp'),
+                                           util.string_to_uid(self.config['bnpl']['file_dir']))
+
+  @property
+  def keys(self):
+    """
+    the set of keys in the index, (re)loaded when stale.
+    """
+    if self._keys is None or self._is_stale(self._built_at):
+      with self._lock:
+        if self._keys is None or self._is_stale(self._built_at):
+          self._load()
+    return self._keys
+
+  def _is_stale(self, ts):
+    """
+    """
+    return time.time() - ts > self.ttl
+
+  def _key(self, url):
+    """
+    normalize a url to a key in the bucket.
+    """
+    root = self.store.s3.s3root
+    if url.startswith(root):
+      url = url[len(root):]
+    return url.lstrip('/')
+
+  def _load(self):
+    """
+    read the index from disk, rebuilding it if it's missing / stale.
+    """
+    try:
+      with open(self.path) as f:
+        header = f.readline()
+        built_at = float(header[1:].strip()) if header.startswith('#') else 0
+        if self._is_stale(built_at):
+          return self.build()
+        keys = set()
+        for line in f:
+          line = line.rstrip('\n')
+          if line.startswith('-'):
+            keys.discard(line[1:])
+          elif line:
+            keys.add(line)
+    except (IOError, ValueError):
+      return self.build()
+    self._keys = keys
+    self._built_at = built_at
+
+  def build(self):
+    """
+    list `file_dir` once and atomically replace the cached index.
+    """
+    keys = set(self._key(url) for url in self.store.s3.ls(self.config['bnpl']['file_dir']))
+    built_at = time.time()
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path))
+    with os.fdopen(fd, 'w') as f:
+      f.write("#{0}\n".format(built_at))
+      for key in keys:
+        f.write(key + "\n")
+    os.rename(tmp, self.path)
+    self._keys = keys
+    self._built_at = built_at
+
+  def add(self, url):
+    """
+    record an uploaded blob.
+    """
+    self._append(self._key(url), "{0}\n")
+
+  def discard(self, url):
+    """
+    record a deleted blob.
+    """
+    self._append(self._key(url), "-{0}\n")
+
+  def _append(self, key, fmt):
+    """
+    """
+    if not self.ttl or self._keys is None:
+      return
+    if fmt.startswith('-'):
+      self._keys.discard(key)
+    else:
+      self._keys.add(key)
+    with open(self.path, 'a') as f:
+      f.write(fmt.format(key))
+
+  def __contains__(self, url):
+    """
+    """
+    if not self.ttl:
+      return False
+    return self._key(url) in self.keys
+
+
+class FileCache(ConfigMixin):
+  """
+  A local, content-addressed cache of blobs keyed by url. Entries are 
+  filled via an atomic rename so several processes can share `cache_dir`, 
+  and the least recently used ones are evicted once the cache grows past
+  `cache_size` bytes (0 disables the cache).
+  """
+
+  def __init__(self, path=None, size=None):
+    conf = self.config['bnpl']
+    self.path = path or conf.get('cache_dir', 
+                                 "{0}/bnpl-cache".format(conf.get('tmp_dir', '/tmp')))
+    self.size = size if size is not None else conf.get('cache_size', CACHE_SIZE)
+    self.hits = 0
+    self.misses = 0
+    self._used = None
+
+  @property
+  def enabled(self):
+    """
+    """
+    return self.size > 0
+
+  def _path(self, url):
+    """
+    location of a url in the cache.
+    """
+    key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    return os.path.join(self.path, key[:2], key)
+
+  def get(self, url):
+    """
+    path to a cached blob or None, marking it as recently used.
+    """
+    p = self._path(url)
+    try:
+      os.utime(p, None)
+    except OSError:
+      self.misses += 1
+      return None
+    self.hits += 1
+    return p
+
+  def tmp(self):
+    """
+    a temporary file to fill a new entry with.
+    """
+    fd, tmp = tempfile.mkstemp(dir=util.path_make_dir(self.path), prefix='.fill-')
+    os.close(fd)
+    return tmp
+
+  def put(self, url, tmp):
+    """
+    atomically move a filled temporary file into the cache.
+    """
+    p = self._path(url)
+    util.path_make_dir(os.path.dirname(p))
+    size = os.path.getsize(tmp)
+    os.rename(tmp, p)
+    if self._used is None:
+      self.evict()
+    else:
+      self._used += size
+      if self._used > self.size:
+        self.evict()
+    return p
+
+  def rm(self, url):
+    """
+    drop a url from the cache.
+    """
+    try:
+      os.remove(self._path(url))
+    except OSError:
+      pass
+
+  def evict(self):
+    """
+    remove the least recently used entries until the cache 
+    is back under 90% of its budget.
+    """
+    entries = []
+    for p in util.path_list(self.path):
+      if os.path.basename(p).startswith('.fill-'):
+        continue
+      try:
+        st = os.stat(p)
+      except OSError:
+        continue
+      entries.append((st.st_mtime, st.st_size, p))
+    used = sum(e[1] for e in entries)
+    if used > self.size:
+      for _, size, p in sorted(entries):
+        if used <= self.size * 0.9:
+          break
+        try:
+          os.remove(p)
+        except OSError:
+          pass
+        used -= size
+    self._used = used
+
+  def stats(self):
+    """
+    hit / miss counters.
+    """
+    total = self.hits + self.misses
+    return {
+      "hits": self.hits,
+      "misses": self.misses,
+      "hit_ratio": float(self.hits) / total if total else 0.0
+    }
+
+
 class S3Store(Store):
   """
   Blob Store works with s3 / local directory
   """
-  s3 = s3plz.connect(Config['aws']['s3_bucket'], 
-                     key=Config['aws']['key'], 
-                     secret=Config['aws']['secret'],
-                     serializer=Config['bnpl']['file_compression'])
+  @property
+  def s3(self):
+    """
+    s3 connection, created on first use.
+    """
+    return get_client('s3', self._connect)
+
+  def _connect(self):
+    """
+    """
+    import s3plz # deferred so that importing bnpl doesn't load boto.
+    return s3plz.connect(self.config['aws']['s3_bucket'], 
+                         key=self.config['aws']['key'], 
+                         secret=self.config['aws']['secret'],
+                         serializer=self.compression)
 
   @util.exec_retry(attempts=3)
-  def get(self, sound):
+  def get(self, sound, to=None):
+    """
+    get sound byes from the blob store, or download them to the path `to`.
+    Blobs are read through the local file cache.
+    """
+    if not self.cache.enabled:
+      if to is not None:
+        self._download(sound, to)
+        return to
+      fd, tmp = tempfile.mkstemp()
+      os.close(fd)
+      try:
+        self._download(sound, tmp)
+        with open(tmp, 'rb') as f:
+          return f.read()
+      finally:
+        util.path_remove(tmp)
+
+    path = self.cache.get(sound.url)
+    if not path:
+      tmp = self.cache.tmp()
+      try:
+        self._download(sound, tmp)
+      except:
+        util.path_remove(tmp)
+        raise
+      path = self.cache.put(sound.url, tmp)
+
+    if to is None:
+      with open(path, 'rb') as f:
+        return f.read()
+    # a copy, not a link: whoever gets it may edit it in place.
+    return util.path_copy(path, to)
+
+  @property
+  def download_pool_size(self):
+    """
+    number of concurrent range requests per download.
+    """
+    return self.config['bnpl'].get('file_download_pool_size', 8)
+
+  def _download(self, sound, path):
+    """
+    Stream a blob to a local path, decompressing it on the fly.
+    Blobs larger than a part are fetched as concurrent byte ranges.
+    """
+    key = self.s3.bucket.get_key(self.s3._format_filepath(sound.url))
+    if key is None:
+      raise ValueError('Sound does not exist in the blob store: {0}'.format(sound.url))
+
+    codec = self._get_codec(key)
+    if key.size <= self.part_size:
+      self._download_chunks(util.file_read_chunks(key), path, codec)
+
+    elif not codec:
+      self._download_ranges(key, path)
+
+    else:
+      raw = "{0}.{1}".format(path, codec)
+      try:
+        self._download_ranges(key, raw)
+        with open(raw, 'rb') as f:
+          self._download_chunks(util.file_read_chunks(f), path, codec)
+      finally:
+        if os.path.exists(raw):
+          util.path_remove(raw)
+
+  def _get_codec(self, key):
+    """
+    the codec a blob was stored with. blobs written before
+    the compression policy existed use the default compression.
+    """
+    codec = key.get_metadata('compression')
+    if codec is None:
+      return self.compression
+    if codec == 'none':
+      return None
+    return codec
+
+  def _download_chunks(self, chunks, path, codec=None):
+    """
+    write decompressed chunks to a local path.
+    """
+    with open(path, 'wb') as f:
+      for chunk in util.decompress_chunks(chunks, codec):
+        f.write(chunk)
+
+  def _download_ranges(self, key, path):
+    """
+    Fetch a blob as concurrent byte ranges, each written in place 
+    into a preallocated file.
+    """
+    with open(path, 'wb') as f:
+      f.truncate(key.size)
+    ranges = [(start, min(start + self.part_size, key.size) - 1) 
+              for start in xrange(0, key.size, self.part_size)]
+    for _ in util.exec_pooled(self._download_range, ranges, 
+                              size=self.download_pool_size, 
+                              name=key.name, path=path):
+      pass
+
+  def _download_range(self, r, name=None, path=None):
+    """
+    write a single byte range of a blob at its offset.
+    """
+    key = self.s3.bucket.new_key(name)
+    with open(path, 'r+b') as f:
+      f.seek(r[0])
+      key.get_contents_to_file(f, headers={'Range': 'bytes={0}-{1}'.format(*r)})
+
+  @property
+  def compression(self):
+    """
+    default compression for files in the blob store.
+    """
+    return self.config['bnpl'].get('file_compression') or None
+
+  @property
+  def compression_pool_size(self):
+    """
+    number of threads compressing blocks of an upload in parallel.
+    """
+    return self.config['bnpl'].get('file_compression_pool_size', 4)
+
+  @property
+  def part_size(self):
+    """
+    size of each part in a multipart upload.
+    """
+    return max(self.config['bnpl'].get('file_part_size', S3_PART_SIZE), S3_MIN_PART_SIZE)
+
+  _index = None
+  _cache = None
+
+  @property
+  def index(self):
     """
-    get sound byes from the blob store.
+    existence index for the blob store.
     """
-    return self.s3.get(sound.url)
+    if self._index is None:
+      self._index = S3Index(self)
+    return self._index
+
+  @property
+  def cache(self):
+    """
+    local cache of downloaded blobs.
+    """
+    if self._cache is None:
+      self._cache = FileCache()
+    return self._cache
 
   @util.exec_retry(attempts=3)
-  def put(self, sound, _ret=True):
+  def put(self, sound, _ret=True, _check=True):
     """
     put a sound into the blob store
     """
-    if not self.exists(sound):
-      with open(sound.path, 'rb') as f:
-        self.s3.put(f.read(), sound.url)
+    if not _check or not self.exists(sound):
+      self._put_file(sound)
+      self.index.add(sound.url)
       if _ret: return sound
 
+  def _put_file(self, sound):
+    """
+    Stream a sound's file into the blob store, compressing it on the fly.
+    Files larger than a single part are sent as a multipart upload so 
+    memory use stays bounded by the part size.
+    """
+    key = self.s3._gen_key_from_fp(sound.url)
+    codec, level = util.compress_parse(sound.compression)
+    metadata = {'compression': codec or 'none'}
+    checksum = hashlib.md5()
+    with open(sound.path, 'rb') as f:
+      parts = util.file_read_parts(f, self.part_size, 
+                                   compression=codec, 
+                                   level=level,
+                                   checksum=checksum,
+                                   pool_size=self.compression_pool_size)
+      first = next(parts, '')
+      second = next(parts, None)
+      if second is None:
+        key.update_metadata(metadata)
+        key.set_contents_from_string(first)
+      else:
+        self._put_multipart(key, itertools.chain([first, second], parts), metadata)
+    key.set_acl(self.s3.acl_str)
+    sound.properties['checksum'] = checksum.hexdigest()
+
+  def _put_multipart(self, key, parts, metadata={}):
+    """
+    Upload parts in order, letting s3 verify each one against its md5.
+    """
+    mp = self.s3.bucket.initiate_multipart_upload(key.name, metadata=metadata)
+    try:
+      for n, part in enumerate(parts, 1):
+        md5 = hashlib.md5(part)
+        mp.upload_part_from_file(StringIO(part), n, 
+                                 md5=(md5.hexdigest(), base64.b64encode(md5.digest())))
+      mp.complete_upload()
+    except:
+      mp.cancel_upload()
+      raise
+
   @util.exec_retry(attempts=3, wait=0.25, backoff=1.1)
   def rm(self, sound):
     """
     Remove a sound from the blob store
     """
     self.s3.delete(sound.url)
+    self.index.discard(sound.url)
+    self.cache.rm(sound.url)
     return sound
 
   @util.exec_retry(attempts=3, wait=0.25, backoff=1.1)
   def exists(self, sound):
     """
-    check if a sound exists in the blob store
+    check if a sound exists in the blob store, only
+    sending a HEAD request when it's missing from the index.
     """
-    return self.s3.exists(sound.url)
+    if sound.url in self.index:
+      return True
+    exists = self.s3.exists(sound.url)
+    if exists:
+      self.index.add(sound.url)
+    return exists
 
-  @util.exec_retry(attempts=2, wait=5, backoff=2)
   def bulk(self, sounds, size=10):
     """
-    Bulk uploader via gevent.
+    Bulk uploader via gevent. Uploads run on a pool of `size` greenlets
+    and a `(sound, error)` tuple is yielded as each one finishes, so 
+    a single failure doesn't cost the rest of the batch.
     """
-    return list(util.exec_pooled(self.run, sounds, _ret=False))
+    return util.exec_pooled(self._bulk_put, sounds, size=size, _stream=True)
+
+  def _bulk_put(self, sound):
+    """
+    put a sound, capturing any error.
+    """
+    try:
+      self.put(sound)
+      return sound, None
+    except Exception as e:
+      return sound, e
 
 
 class ElasticStore(Store):
   """
   
   """
-  es = Elasticsearch(Config['elastic']['urls'])
-  index = Config['elastic']['index']
-  doc_type = Config['elastic']['doc_type']
+  @property
+  def es(self):
+    """
+    elasticsearch client, created on first use.
+    """
+    return get_client('es', self._connect)
+
+  @property
+  def index(self):
+    """
+    """
+    return self.config['elastic']['index']
+
+  @property
+  def doc_type(self):
+    """
+    """
+    return self.config['elastic']['doc_type']
+
+  def _connect(self):
+    """
+    """
+    from elasticsearch import Elasticsearch
+    return Elasticsearch(self.config['elastic']['urls'])
 
   def get(self, sound):
     """
-    Get a sound from ElasticSearch
+    Get a sound from ElasticSearch, or the read cache.
     """
-    hit = self.es.get(index=self.index, 
-                      doc_type=self.doc_type, id=sound.uid)
+    self._check_generation()
+    hit = self._doc_cache.get(sound.uid)
+    if hit is None:
+      hit = self.es.get(index=self.index, 
+                        doc_type=self.doc_type, id=sound.uid,
+                        _source_excludes=list(DERIVED_FIELDS))
+      self._doc_cache.set(sound.uid, hit)
     return self._sound_from_hit(hit)
 
   def mget(self, sounds):
     """
+    Get many sounds, fetching only those that aren't cached.
+    Missing sounds are skipped.
+    """
+    self._check_generation()
+    uids = [sound.uid for sound in sounds]
+    hits = {}
+    misses = []
+    for uid in uids:
+      hit = self._doc_cache.get(uid)
+      if hit is None:
+        misses.append(uid)
+      else:
+        hits[uid] = hit
+    if misses:
+      res = self.es.mget(index=self.index, 
+                         doc_type=self.doc_type,
+                         body={'docs': [{'_id': uid, '_source': {'excludes': list(DERIVED_FIELDS)}} 
+                                        for uid in misses]})
+      for doc in res.get('docs', []):
+        if doc.get('found'):
+          self._doc_cache.set(doc['_id'], doc)
+          hits[doc['_id']] = doc
+    return [self._sound_from_hit(hits[uid]) for uid in uids if uid in hits]
+
+  def exists_bulk(self, sounds):
+    """
+    Check which sounds exist with a single request. 
+    Returns a dict of uid > created_at for those that do.
     """
     res = self.es.mget(index=self.index, 
                        doc_type=self.doc_type,
-                       ids=[sound.uid for sound in sounds])
-    return self._sounds_from_res(res)
+                       body={'docs': [{'_id': sound.uid, '_source': ['created_at']} 
+                                      for sound in sounds]})
+    return {
+      doc['_id']: util.date_from_any(doc.get('_source', {}).get('created_at'))
+      for doc in res.get('docs', []) if doc.get('found')
+    }
 
-  def query(self, query):
+  def stored_bulk(self, sounds):
     """
+    Fetch the stored documents for sounds with a single request,
+    without derived fields. Returns a dict of uid > _source for 
+    those that exist.
+    """
+    res = self.es.mget(index=self.index, 
+                       doc_type=self.doc_type,
+                       body={'docs': [{'_id': sound.uid, '_source': {'excludes': list(DERIVED_FIELDS)}} 
+                                      for sound in sounds]})
+    return {
+      doc['_id']: doc.get('_source', {})
+      for doc in res.get('docs', []) if doc.get('found')
+    }
 
+  def query(self, query, stream=False, fields=None, **kwargs):
+    """
+    Search for sounds. With `stream`, every match is 
+    yielded lazily via `scan`. With `fields`, only those
+    fields are fetched.
     """
+    if stream:
+      return self.scan(query, fields=fields, **kwargs)
+    body = dict(query or {})
+    body['_source'] = self._source(fields)
     res = self.es.search(index=self.index, 
                          doc_type=self.doc_type,
-                         body=query)
-    return self._sounds_from_res(res)
+                         body=body)
+    return self._sounds_from_res(res, partial=bool(fields))
+
+  def scan(self, query=None, size=500, slices=None, keep_alive='1m', fields=None):
+    """
+    Lazily yield every sound matching a query. Pages with a point in time
+    + search_after on clusters that support it, otherwise with a scroll.
+    The next page is fetched while the current one is consumed. With 
+    `slices`, the query is split into that many slices paged in parallel.
+    With `fields`, only those fields are fetched.
+    """
+    body = dict(query or {})
+    body['_source'] = self._source(fields)
+    for hit in self._scan_hits(body, size, slices, keep_alive):
+      yield self._sound_from_hit(hit, partial=bool(fields))
+
+  def _source(self, fields=None):
+    """
+    source filtering: skip derived fields and, given `fields`, 
+    fetch only those (plus what a sound needs).
+    """
+    source = {'excludes': list(DERIVED_FIELDS)}
+    if fields:
+      fields = list(SOURCE_REQUIRED) + [_filter_field(f) for f in fields]
+      source['includes'] = list(OrderedDict.fromkeys(fields))
+    return source
+
+  def _scan_hits(self, query=None, size=500, slices=None, keep_alive='1m'):
+    """
+    raw hits for `scan`. Slices share one point in time, 
+    so together they read a single snapshot.
+    """
+    pit = self._pit_open(keep_alive)
+    pages = None
+    try:
+      if slices and slices > 1:
+        pages = util.exec_merge([self._pages(query, size, keep_alive, (i, slices), pit) 
+                                 for i in xrange(slices)])
+      else:
+        pages = util.exec_prefetch(self._pages(query, size, keep_alive, pit=pit))
+      for hits in pages:
+        for hit in hits:
+          yield hit
+    finally:
+      if pages is not None:
+        pages.close()
+      self._pit_close(pit)
+
+  _version = None
+
+  @property
+  def version(self):
+    """
+    (major, minor) version of the cluster.
+    """
+    if self._version is None:
+      number = self.es.info()['version']['number']
+      self._version = tuple(int(n) for n in re.findall(r'\d+', number)[:2])
+    return self._version
+
+  def _pit_open(self, keep_alive):
+    """
+    open a point in time on clusters that support it, else None. 
+    The returned dict holds the latest id, which searches may change.
+    """
+    if self.version < (7, 12):
+      return None
+    return {'id': self.es.open_point_in_time(index=self.index, keep_alive=keep_alive)['id']}
+
+  def _pit_close(self, pit):
+    """
+    """
+    if pit is None:
+      return
+    try:
+      self.es.close_point_in_time(body={'id': pit['id']})
+    except Exception:
+      pass
+
+  def _pages(self, query, size, keep_alive, slice=None, pit=None):
+    """
+    pages of hits for a query, through `pit` if given.
+    """
+    body = dict(query or {})
+    body.pop('from', None)
+    if slice:
+      body['slice'] = {'id': slice[0], 'max': slice[1]}
+    if pit is not None:
+      return self._pages_pit(body, size, keep_alive, pit)
+    return self._pages_scroll(body, size, keep_alive)
+
+  def _pages_pit(self, body, size, keep_alive, pit):
+    """
+    page through a point in time with search_after.
+    """
+    body.setdefault('sort', [{'_shard_doc': 'asc'}])
+    body['size'] = size
+    while True:
+      body['pit'] = {'id': pit['id'], 'keep_alive': keep_alive}
+      res = self.es.search(body=body)
+      pit['id'] = res.get('pit_id', pit['id'])
+      hits = res['hits']['hits']
+      if not hits:
+        break
+      yield hits
+      body['search_after'] = hits[-1]['sort']
+
+  def _pages_scroll(self, body, size, keep_alive):
+    """
+    page through a scroll.
+    """
+    body.setdefault('sort', ['_doc'])
+    res = self.es.search(index=self.index, 
+                         doc_type=self.doc_type, 
+                         body=body, 
+                         scroll=keep_alive, 
+                         size=size)
+    scroll_id = res.get('_scroll_id')
+    try:
+      while True:
+        hits = res['hits']['hits']
+        if not hits:
+          break
+        yield hits
+        res = self.es.scroll(scroll_id=scroll_id, scroll=keep_alive)
+        scroll_id = res.get('_scroll_id', scroll_id)
+    finally:
+      try:
+        self.es.clear_scroll(scroll_id=scroll_id)
+      except Exception:
+        pass
+
+  def facets(self, filters=None, facets=None):
+    """
+    Bucket counts for sounds matching a filter string, computed by 
+    elasticsearch. `facets` picks which of `ES_FACETS` to compute.
+    Results are cached for `facet_ttl` seconds and dropped on writes
+    from this process.
+    """
+    self._check_generation()
+    names = sorted(n for n in (facets or ES_FACETS) if n in ES_FACETS)
+    key = (util.filter_normalize(filters or ''), tuple(names))
+    res = self._facet_cache.get(key)
+    if res is None:
+      res = self._facets(filters, names)
+      self._facet_cache.set(key, res)
+    return copy.deepcopy(res)
+
+  @property
+  def _facet_cache(self):
+    """
+    """
+    ttl = self.config['elastic'].get('facet_ttl', 30)
+    return get_client('facets', partial(util.LRU, size=256, ttl=ttl))
+
+  @property
+  def _doc_cache(self):
+    """
+    """
+    conf = self.config['elastic']
+    return get_client('docs', partial(util.LRU, size=conf.get('doc_cache_size', 10000), 
+                                      ttl=conf.get('doc_cache_ttl', 60)))
+
+  @property
+  def _generation(self):
+    """
+    writes by other processes on this host.
+    """
+    path = "{0}/bnpl-generation-{1}".format(self.config['bnpl'].get('tmp_dir', '/tmp'), self.index)
+    interval = self.config['elastic'].get('doc_cache_check', 1)
+    return get_client('generation', partial(util.Generation, path, interval))
+
+  def _check_generation(self):
+    """
+    drop cached reads if another process wrote.
+    """
+    if self._generation.changed():
+      self._doc_cache.clear()
+      self._facet_cache.clear()
+
+  def cache_stats(self):
+    """
+    read cache counters.
+    """
+    return {
+      'docs': self._doc_cache.stats(),
+      'facets': self._facet_cache.stats()
+    }
+
+  def _facets(self, filters, names):
+    """
+    run a facet aggregation.
+    """
+    body = filter_to_query(filters) if filters else {'query': {'match_all': {}}}
+    body.pop('sort', None)
+    body['size'] = 0
+    body['aggs'] = {n: ES_FACETS[n] for n in names}
+    res = self.es.search(index=self.index, doc_type=self.doc_type, 
+                         body=body, request_cache='true')
+    total = res['hits']['total']
+    return {
+      'total': total['value'] if isinstance(total, dict) else total,
+      'facets': {
+        n: [{'key': b['key'], 'count': b['doc_count']} for b in agg['buckets']]
+        for n, agg in res.get('aggregations', {}).iteritems()
+      }
+    }
+
+  def _invalidate(self, uids=()):
+    """
+    drop cached reads after a write, here and in other processes.
+    """
+    for uid in uids:
+      self._doc_cache.pop(uid)
+    self._facet_cache.clear()
+    self._generation.bump()
 
   @util.exec_retry(attempts=3)
   def put(self, sound):
     """
-    Upsert a record
-    """
-    self.es.index(index=self.index, 
-                  doc_type=self.doc_type, 
-                  id=sound.uid,
-                  body=sound.to_dict())
+    Upsert a record. Sounds loaded from the store only send the 
+    fields that changed, or nothing at all.
+    """
+    if not sound.tracked:
+      self.es.index(index=self.index, 
+                    doc_type=self.doc_type, 
+                    id=sound.uid,
+                    body=sound.to_dict())
+    else:
+      doc = self._partial(sound)
+      if doc is None:
+        return sound
+      self.es.update(index=self.index, 
+                     doc_type=self.doc_type, 
+                     id=sound.uid,
+                     body={'doc': doc})
+    sound.mark_clean()
+    self._invalidate([sound.uid])
     return sound
 
   @util.exec_retry(attempts=3)
@@ -161,9 +1080,11 @@ class ElasticStore(Store):
     """
     Delete a record
     """
-    return self.es.delete(index=self.index, 
-                          doc_type=self.doc_type, 
-                          id=sound.uid)
+    res = self.es.delete(index=self.index, 
+                         doc_type=self.doc_type, 
+                         id=sound.uid)
+    self._invalidate([sound.uid])
+    return res
 
   @util.exec_retry(attempts=3)
   def exists(self, sound):
@@ -174,12 +1095,275 @@ class ElasticStore(Store):
                           doc_type=self.doc_type, 
                           id=sound.uid)
 
-  @util.exec_retry(attempts=3)
-  def bulk(self, sounds):
+  def bulk(self, sounds, index=None, size=ES_BULK_SIZE, max_bytes=ES_BULK_MAX_BYTES, 
+           pool_size=4, attempts=3):
+    """
+    Bulk load sounds. Returns a list of `(sound, error)` 
+    tuples once every sound is written. See `bulk_iter`.
+    """
+    return list(self.bulk_iter(sounds, index=index, size=size, max_bytes=max_bytes, 
+                               pool_size=pool_size, attempts=attempts))
+
+  def bulk_iter(self, sounds, index=None, size=ES_BULK_SIZE, max_bytes=ES_BULK_MAX_BYTES, 
+                pool_size=4, attempts=3):
+    """
+    Bulk load sounds lazily. Sounds are streamed into batches of at most 
+    `size` documents / `max_bytes` bytes which are sent `pool_size` at a 
+    time. Items the cluster rejects as overloaded are retried on their own. 
+    Yields a `(sound, error)` tuple per sound; nothing is written 
+    until it's iterated.
+    """
+    results = self._bulk(sounds, partial(self._format_bulk, index=index), 
+                         size, max_bytes, pool_size, attempts)
+    for sound, err in results:
+      if err is None:
+        sound.mark_clean()
+      yield sound, err
+
+  def _bulk(self, items, format, size, max_bytes, pool_size, attempts):
+    """
+    bulk load arbitrary items given a function that formats their actions.
+    """
+    batches = self._bulk_batches(items, format, size, max_bytes)
+    for results in util.exec_pooled(self._bulk_send, batches, size=pool_size, 
+                                    _stream=True, _maxsize=pool_size, 
+                                    attempts=attempts):
+      self._invalidate([getattr(item, 'uid', None) for item, _ in results])
+      for result in results:
+        yield result
+
+  def _bulk_batches(self, items, format, size, max_bytes):
+    """
+    cut bulk actions into batches by count and bytes.
+    """
+    batch = []
+    n = 0
+    for item in items:
+      action = format(item)
+      # unchanged sounds have no action and aren't sent.
+      nbytes = util.string_size(action) if action is not None else 0
+      if batch and (len(batch) >= size or n + nbytes > max_bytes):
+        yield batch
+        batch = []
+        n = 0
+      batch.append((item, action))
+      n += nbytes + 1
+    if batch:
+      yield batch
+
+  def _bulk_send(self, batch, attempts=3):
+    """
+    send a batch, retrying only the items that failed 
+    with a retryable status. Items without an action
+    have nothing to write.
+    """
+    results = [(item, None) for item, action in batch if action is None]
+    batch = [(item, action) for item, action in batch if action is not None]
+    if not batch:
+      return results
+    wait = 0.5
+    for attempt in xrange(1, attempts + 1):
+      retry = []
+      try:
+        res = self.es.bulk(body="\n".join(a for _, a in batch) + "\n")
+      except Exception as e:
+        if attempt == attempts or not _es_retryable(e):
+          return results + [(sound, e) for sound, _ in batch]
+        retry = batch
+        res = {}
+
+      for (sound, action), item in zip(batch, res.get('items', [])):
+        op = list(item.values())[0]
+        status = op.get('status', 500)
+        if status < 300:
+          results.append((sound, None))
+        elif status in ES_RETRY_STATUSES and attempt < attempts:
+          retry.append((sound, action))
+        else:
+          results.append((sound, StoreError(op.get('error'))))
+
+      if not retry:
+        break
+      batch = retry
+      time.sleep(wait)
+      wait *= 2
+    return results
+
+  @contextlib.contextmanager
+  def bulk_mode(self):
+    """
+    Disable refreshes and replicas for the duration of a massive import.
+    Processes share a lock document in `lock_index` holding a lease per 
+    process: the first one in saves the current settings and applies the 
+    bulk ones, the last one out restores them and refreshes. Leases are 
+    renewed while the import runs and expire after `lock_ttl` seconds, so
+    a process killed outright is dropped by the next one to touch the 
+    lock (or by `expire_bulk_mode`). Settings are restored on errors, 
+    Ctrl-C and SIGTERM.
+    """
+    term = _sigterm_to_exit()
+    token = "{0}-{1}-{2}".format(socket.gethostname(), os.getpid(), util.string_to_uid())
+    self._bulk_mode_enter(token)
+    renew = gevent.spawn(self._bulk_mode_renew, token)
+    try:
+      yield self
+    finally:
+      renew.kill()
+      try:
+        self._bulk_mode_exit(token)
+      finally:
+        if term is not None:
+          signal.signal(signal.SIGTERM, term)
+
+  def expire_bulk_mode(self):
+    """
+    Drop expired leases, restoring the index settings if none are left.
+    """
+    return self._bulk_mode_exit(None)
+
+  @property
+  def lock_index(self):
+    """
+    """
+    return self.config['elastic'].get('lock_index', '.{0}-locks'.format(self.index))
+
+  @property
+  def lock_ttl(self):
+    """
+    """
+    return self.config['elastic'].get('lock_ttl', 300)
+
+  def _leases(self, state):
+    """
+    unexpired leases in a lock document.
+    """
+    now = time.time()
+    return {t: exp for t, exp in (state.get('leases') or {}).iteritems() if exp > now}
+
+  def _bulk_mode_enter(self, token):
+    """
+    take a lease, applying bulk settings if we're first. Settings saved 
+    by holders whose leases expired are kept: the index still has the 
+    bulk ones.
+    """
+    while True:
+      doc = self._lock_get()
+      if doc is None:
+        state = {'settings': self._index_settings()}
+      else:
+        state = doc['_source']
+      state['leases'] = self._leases(state)
+      first = not state['leases']
+      state['leases'][token] = time.time() + self.lock_ttl
+      if self._lock_put(state, doc):
+        break
+    if first:
+      self.es.indices.put_settings(index=self.index, body={'index': ES_BULK_SETTINGS})
+
+  def _bulk_mode_renew(self, token):
+    """
+    keep our lease alive.
+    """
+    while True:
+      gevent.sleep(self.lock_ttl / 3.0)
+      while True:
+        doc = self._lock_get()
+        if doc is None:
+          return
+        state = doc['_source']
+        state['leases'] = self._leases(state)
+        state['leases'][token] = time.time() + self.lock_ttl
+        if self._lock_put(state, doc):
+          break
+
+  def _bulk_mode_exit(self, token):
+    """
+    give up our lease (and any expired ones), restoring 
+    settings if none are left.
+    """
+    while True:
+      doc = self._lock_get()
+      if doc is None:
+        if token is not None:
+          logging.warning('Bulk mode lock for {0} is missing.'.format(self.index))
+        return False
+      state = doc['_source']
+      before = state.get('leases') or {}
+      state['leases'] = self._leases(state)
+      state['leases'].pop(token, None)
+      if state['leases'] == before:
+        break
+      if self._lock_put(state, doc):
+        doc = self._lock_get()
+        break
+    if state['leases']:
+      return False
+    self.es.indices.put_settings(index=self.index, body={'index': state['settings']})
+    self.refresh()
+    # a conflict means another process came in meanwhile and owns it now.
+    self._lock_rm(doc)
+    return True
+
+  def _index_settings(self):
+    """
+    the settings bulk mode overrides, as they are now.
+    """
+    conf = self.config['elastic']
+    res = self.es.indices.get_settings(index=self.index)
+    current = list(res.values())[0]['settings']['index'] if res else {}
+    return {
+      'refresh_interval': current.get('refresh_interval', conf.get('refresh_interval', '1s')),
+      'number_of_replicas': int(current.get('number_of_replicas', conf.get('replicas', 1)))
+    }
+
+  def _lock_get(self):
+    """
+    """
+    try:
+      return self.es.get(index=self.lock_index, doc_type=self.doc_type, id=self.index)
+    except Exception as e:
+      if getattr(e, 'status_code', None) == 404:
+        return None
+      raise
+
+  def _lock_put(self, state, doc=None):
     """
-    Bulk load sounds
+    write the lock document if nobody changed it since `doc` was read.
+    Returns False on a conflict.
     """
-    return self.es.bulk(body="\n".join([self._format_bulk(sound) for sound in sounds]))
+    kw = {'index': self.lock_index, 'doc_type': self.doc_type, 
+          'id': self.index, 'body': state}
+    if doc is None:
+      kw['op_type'] = 'create'
+    else:
+      kw.update(self._lock_version(doc))
+    try:
+      self.es.index(**kw)
+      return True
+    except Exception as e:
+      if getattr(e, 'status_code', None) == 409:
+        return False
+      raise
+
+  def _lock_rm(self, doc):
+    """
+    """
+    if doc is None or self._leases(doc['_source']):
+      return
+    try:
+      self.es.delete(index=self.lock_index, doc_type=self.doc_type, 
+                     id=self.index, **self._lock_version(doc))
+    except Exception as e:
+      if getattr(e, 'status_code', None) not in (404, 409):
+        raise
+
+  def _lock_version(self, doc):
+    """
+    optimistic concurrency arguments for a document.
+    """
+    if self.version < (6, 7):
+      return {'version': doc['_version']}
+    return {'if_seq_no': doc['_seq_no'], 'if_primary_term': doc['_primary_term']}
 
   @util.exec_retry(attempts=3)
   def refresh(self):
@@ -188,29 +1372,277 @@ class ElasticStore(Store):
     """
     return self.es.indices.refresh(index=self.index)
 
+  @property
+  def mapping(self):
+    """
+    Explicit mapping for sound documents. Unknown strings are keywords
+    (no text + .keyword pairs), unknown numbers are doubles, and the 
+    fpcalc fingerprint is stored but never indexed.
+    """
+    keyword = {'type': 'keyword'}
+    date = {'type': 'date'}
+    return {
+      'dynamic_templates': [
+        {'strings': {'match_mapping_type': 'string', 
+                     'mapping': {'type': 'keyword', 'ignore_above': 256}}},
+        {'numbers': {'match_mapping_type': 'long', 
+                     'mapping': {'type': 'double'}}}
+      ],
+      'properties': {
+        'uid': keyword,
+        'path': keyword,
+        'ext': keyword,
+        'mimetype': keyword,
+        'slug': keyword,
+        'filename': keyword,
+        'url': keyword,
+        'created_at': date,
+        'updated_at': date,
+        'properties': {
+          'properties': {
+            'bpm': {'type': 'float'},
+            'duration': {'type': 'float'},
+            'key': keyword,
+            'chord': keyword,
+            'artist': keyword,
+            'album': keyword,
+            'title': keyword,
+            'genre': keyword,
+            'checksum': keyword,
+            'fingerprint': {'type': 'keyword', 'index': False, 'doc_values': False}
+          }
+        }
+      }
+    }
 
-  def _format_bulk(self, sound):
+  @property
+  def template(self):
+    """
+    Index template applied to the index and any versions of it.
+    """
+    conf = self.config['elastic']
+    pattern = "{0}*".format(self.index)
+    body = {
+      'settings': {
+        'number_of_shards': conf.get('shards', 1),
+        'number_of_replicas': conf.get('replicas', 1),
+        'refresh_interval': conf.get('refresh_interval', '1s')
+      },
+      'mappings': self._typed(self.mapping)
+    }
+    if self.version < (6, 0):
+      body['template'] = pattern
+    else:
+      body['index_patterns'] = [pattern]
+    return body
+
+  def _typed(self, mapping):
+    """
+    nest a mapping under the doc type on clusters that still have them.
+    """
+    if self.version < (7, 0):
+      return {self.doc_type: mapping}
+    return mapping
+
+  def put_template(self):
+    """
+    Install / replace the index template.
+    """
+    return self.es.indices.put_template(name=self.index, body=self.template)
+
+  def create_index(self, index=None, upgrade=False):
+    """
+    Install the template and create the index if it doesn't exist. With 
+    `upgrade`, push the mapping onto an existing index. Only new fields 
+    can be added this way; changing existing ones requires a reindex.
+    """
+    index = index or self.index
+    self.put_template()
+    if not self.es.indices.exists(index=index):
+      return self.es.indices.create(index=index)
+    if upgrade:
+      if self.version < (7, 0):
+        return self.es.indices.put_mapping(index=index, doc_type=self.doc_type, body=self.mapping)
+      return self.es.indices.put_mapping(index=index, body=self.mapping)
+    return {'acknowledged': True, 'index': index, 'exists': True}
+
+
+  def reindex(self, rederive=False, slices=4, size=ES_BULK_SIZE, pool_size=4):
+    """
+    Copy every sound into a new, versioned index and then atomically 
+    point the `index` alias at it. Reads keep hitting the old index until
+    the swap; writes made during the copy aren't carried over. With 
+    `rederive`, documents go through `Sound` so slug / filename / url 
+    are recomputed. If `index` is still a concrete index it's replaced 
+    by the alias in the same atomic step.
+    """
+    alias = self.index
+    new = "{0}_v{1}".format(alias, util.ts_now())
+    self.create_index(index=new)
+
+    if rederive:
+      results = self.bulk_iter(self.scan(slices=slices, size=size, keep_alive='5m'), 
+                               index=new, size=size, pool_size=pool_size)
+    else:
+      results = self._bulk(self._scan_hits(size=size, slices=slices, keep_alive='5m'),
+                           partial(self._format_copy, index=new), 
+                           size, ES_BULK_MAX_BYTES, pool_size, 3)
+    count = 0
+    errors = 0
+    for item, err in results:
+      count += 1
+      if err is not None:
+        errors += 1
+        logging.error('Error copying document into {0}: {1}'.format(new, err))
+    if errors:
+      raise StoreError('{0} of {1} documents failed to copy into {2}. '
+                       'The alias still points at the old index.'.format(errors, count, new))
+
+    self.es.indices.refresh(index=new)
+    previous = self._swap_alias(alias, new)
+    return {'alias': alias, 'index': new, 'previous': previous, 'count': count}
+
+  def _swap_alias(self, alias, index):
+    """
+    atomically move an alias onto an index.
+    """
+    actions = []
+    if self.es.indices.exists_alias(name=alias):
+      previous = list(self.es.indices.get_alias(name=alias).keys())
+      for i in previous:
+        actions.append({'remove': {'index': i, 'alias': alias}})
+    elif self.es.indices.exists(index=alias):
+      previous = [alias]
+      actions.append({'remove_index': {'index': alias}})
+    else:
+      previous = []
+    actions.append({'add': {'index': index, 'alias': alias}})
+    self.es.indices.update_aliases(body={'actions': actions})
+    return previous
+
+  def _format_copy(self, hit, index=None):
+    """
+    Bulk request format for copying a raw document.
+    """
+    action = {"index": {"_index": index or self.index, "_type": self.doc_type, "_id": hit['_id']}}
+    return '{0}\n{1}'.format(util.dict_to_json(action), util.dict_to_json(hit['_source']))
+
+  def _format_bulk(self, sound, index=None):
     """
     Bulk request format
     """
-    return '{"update": {"_index":"{0}", "_type": "{1}", "_id": "{2}"}}\n{"doc":{3}}'\
-              .format(self.config['elastic']['index'], 
-                      self.doc_type,
-                      sound.uid,
-                      sound.to_json())
+    action = {"update": {"_index": index or self.index, "_type": self.doc_type, "_id": sound.uid}}
+    if not sound.tracked or index:
+      return '{0}\n{{"doc": {1}, "doc_as_upsert": true}}'.format(util.dict_to_json(action), 
+                                                                  sound.to_json())
+    doc = self._partial(sound)
+    if doc is None:
+      return None
+    return '{0}\n{{"doc": {1}}}'.format(util.dict_to_json(action), util.dict_to_json(doc))
 
-  def _sound_from_hit(self, hit):
+  def _partial(self, sound):
     """
-    Helper
+    partial update doc for a tracked sound, 
+    None if nothing changed.
+    """
+    doc = sound.dirty
+    if not doc:
+      return None
+    doc['updated_at'] = sound.updated_at
+    return doc
+
+  def _sound_from_hit(self, hit, partial=False):
+    """
+    Helper. Partially fetched sounds are tracked as such, 
+    so they're only ever merged into the stored document.
     """ 
-    return Sound(**hit.get("_source",{}))
+    source = hit.get("_source",{})
+    sound = Sound.from_store(source)
+    sound.mark_clean(source, partial=partial)
+    return sound
 
-  def _sounds_from_res(self, res):
+  def _sounds_from_res(self, res, partial=False):
     """
     Helper
     """
     for hit in res.get('hits', []).get('hits', []):
-      yield self._sound_from_hit(hit)
+      yield self._sound_from_hit(hit, partial)
+
+
+def _es_retryable(e):
+  """
+  whether a failed request is worth sending again: 
+  connection trouble or an overloaded cluster.
+  """
+  from elasticsearch import TransportError, ConnectionError
+  if isinstance(e, ConnectionError):
+    return True
+  return isinstance(e, TransportError) and e.status_code in ES_RETRY_STATUSES
+
+
+# SoundBatch column types. everything else is a sparse column.
+BATCH_SCALAR = ('uid', 'path', 'created_at', 'updated_at')
+BATCH_NUMERIC = ('bpm', 'duration')
+BATCH_CATEGORICAL = ('ext', 'mimetype', 'key', 'chord', 'artist', 'album', 'genre')
+
+# one shared copy of each property key.
+_KEYS = {}
+_KEYS_MAX = 4096
+
+def _intern_key(k):
+  """
+  canonical copy of a property key. works for unicode, unlike `intern`.
+  """
+  try:
+    return _KEYS[k]
+  except KeyError:
+    if len(_KEYS) < _KEYS_MAX:
+      _KEYS[k] = k
+    return k
+
+def _copy_value(v):
+  """
+  copy mutable values so changes made in place can be seen.
+  """
+  if isinstance(v, (list, dict, set)):
+    return copy.deepcopy(v)
+  return v
+
+def _stored_properties(stored):
+  """
+  properties of a stored document, laid out the way `_set_properties` reads them.
+  """
+  props = {k: v for k, v in stored.iteritems() 
+           if k not in SOUND_FIELDS and k != 'properties'}
+  props.update(stored.get('properties') or {})
+  return props
+
+def _date_from_store(ds):
+  """
+  stored dates are iso8601.
+  """
+  if not ds:
+    return None
+  if isinstance(ds, datetime):
+    return ds
+  return util.date_from_iso(ds) or util.date_from_any(ds)
+
+def _sigterm_to_exit():
+  """
+  Turn SIGTERM into SystemExit so `finally` blocks run. Returns the
+  previous handler, or None if it couldn't / didn't need to be replaced.
+  """
+  previous = signal.getsignal(signal.SIGTERM)
+  if previous != signal.SIG_DFL:
+    return None
+  def handler(signum, frame):
+    raise SystemExit(128 + signum)
+  try:
+    signal.signal(signal.SIGTERM, handler)
+  except ValueError:
+    # not the main thread.
+    return None
+  return previous
 
 
 class Sound(ConfigMixin):
@@ -223,11 +1655,30 @@ class Sound(ConfigMixin):
   currently exists. 
 
   A sound is saved to s3 and elasticsearch 
+
+  Sounds loaded from the store remember their stored state so 
+  only changed fields are written back.
+
+  Sounds are slotted and share property keys, since millions of 
+  them can be alive in a single stream.
   """
+  __slots__ = ('path', 'created_at', 'updated_at', 'ext', 'uid', 
+               'mimetype', 'properties', '_clean', '_partial', '_derived')
 
   # TODO: make these configurable
-  fs = S3Store()
-  db = ElasticStore() 
+  @property
+  def fs(self):
+    """
+    file store, created on first use.
+    """
+    return get_client('fs', S3Store)
+
+  @property
+  def db(self):
+    """
+    record store, created on first use.
+    """
+    return get_client('db', ElasticStore)
 
   def  __init__(self, **properties):
     self.path = properties.pop('path','')
@@ -237,6 +1688,52 @@ class Sound(ConfigMixin):
     self.uid = properties.pop('uid', util.string_to_uid(self.path))
     self.mimetype = properties.pop('mimetype', self._get_mimetype(self.path))
     self._set_properties(properties)
+    self._clean = None
+    self._partial = False
+    self._derived = None
+
+  @classmethod
+  def from_store(cls, source):
+    """
+    Build a sound from a stored record, trusting it: dates are read as 
+    iso8601 and the mimetype isn't looked up again.
+    """
+    sound = cls.__new__(cls)
+    properties = dict(source)
+    sound.path = properties.pop('path', '')
+    sound.created_at = _date_from_store(properties.pop('created_at', None))
+    sound.updated_at = _date_from_store(properties.pop('updated_at', None))
+    sound.ext = properties.pop('ext', None) or util.path_get_ext(sound.path)
+    sound.uid = properties.pop('uid', None) or util.string_to_uid(sound.path)
+    sound.mimetype = properties.pop('mimetype', None)
+    if not sound.mimetype and (sound.path or sound.ext):
+      # a record without a path, eg: a key for a lookup by uid and ext.
+      sound.mimetype = sound._get_mimetype(sound.path or 'sound.{0}'.format(sound.ext))
+    sound._set_properties(properties)
+    # the source may become this sound's snapshot; don't share mutables with it.
+    for k, v in sound.properties.items():
+      sound.properties[k] = _copy_value(v)
+    sound._clean = None
+    sound._partial = False
+    sound._derived = None
+    return sound
+
+  def __getstate__(self):
+    """
+    slot values for pickling, which needs them spelled 
+    out below protocol 2. Memoized fields aren't kept.
+    """
+    state = {k: getattr(self, k, None) for k in Sound.__slots__}
+    state['_derived'] = None
+    return state
+
+  def __setstate__(self, state):
+    """
+    """
+    for k, v in state.iteritems():
+      setattr(self, k, v)
+    if self.properties:
+      self.properties = {_intern_key(k): v for k, v in self.properties.iteritems()}
 
   def _get_mimetype(self, path):
     """
@@ -248,9 +1745,12 @@ class Sound(ConfigMixin):
     """
     set / update properties
     """
-    _properties = properties.pop('properties', {})
-    self.properties = properties
-    self.properties.update(_properties)
+    for k in DERIVED_FIELDS:
+      properties.pop(k, None)
+    _properties = properties.pop('properties', None) or {}
+    self.properties = {_intern_key(k): v for k, v in properties.iteritems()}
+    for k, v in _properties.iteritems():
+      self.properties[_intern_key(k)] = v
 
   def _format_slug_key(self, k):
     """
@@ -259,8 +1759,28 @@ class Sound(ConfigMixin):
     if not v: return ""
     return "{0}{slug_delim}".format(util.string_to_slug(str(v)), **self.config['bnpl'])
 
+  def _memo(self, name, inputs, fn):
+    """
+    cache a derived value until its inputs change.
+    """
+    if self._derived is None:
+      self._derived = {}
+    cached = self._derived.get(name)
+    if cached is not None and cached[0] == inputs:
+      return cached[1]
+    value = fn()
+    self._derived[name] = (inputs, value)
+    return value
+
   @property
   def slug(self):
+    """
+    """
+    inputs = (self.path,) + tuple(getattr(self, k, self.properties.get(k, None)) 
+                                  for k in self.config['bnpl']['slug_keys'])
+    return self._memo('slug', inputs, self._slug)
+
+  def _slug(self):
     """
     """
     # create format string
@@ -274,7 +1794,13 @@ class Sound(ConfigMixin):
     """
     generate a filename for a sound
     """
-    fn = "{}.{}.{}".format(self.slug, self.ext, self.config['bnpl'].get('file_compression', ''))
+    return self._memo('filename', (self.slug, self.ext, self.mimetype), self._filename)
+
+  def _filename(self):
+    """
+    """
+    codec, _ = util.compress_parse(self.compression)
+    fn = "{}.{}.{}".format(self.slug, self.ext, codec or '')
 
     # handle no compression
     if fn.endswith('.'):
@@ -282,6 +1808,19 @@ class Sound(ConfigMixin):
 
     return fn
 
+  @property
+  def compression(self):
+    """
+    codec (and level) this sound's file is stored with, 
+    per `file_compression_policy`.
+    """
+    policy = COMPRESSION_POLICY.copy()
+    policy.update(self.config['bnpl'].get('file_compression_policy') or {})
+    for k in (self.mimetype, self.ext):
+      if k in policy:
+        return policy[k] or None
+    return self.config['bnpl'].get('file_compression') or None
+
   @property
   def tempfilename(self):
     """
@@ -297,6 +1836,11 @@ class Sound(ConfigMixin):
     this is designed to 
     break if certain things arent present
     """
+    return self._memo('url', (self.uid, self.ext), self._url)
+
+  def _url(self):
+    """
+    """
     if self.uid is None:
       raise ValueError('You must include a uid when saving a sound')
     return "{0}/uid={1}/ext={2}/{1}.{2}".format(self.config['bnpl']['file_dir'], self.uid, self.ext)
@@ -329,6 +1873,79 @@ class Sound(ConfigMixin):
       "properties": self.properties
     }
 
+  @property
+  def tracked(self):
+    """
+    whether this sound's stored state is known.
+    """
+    return self._clean is not None
+
+  @property
+  def dirty(self):
+    """
+    fields changed since the sound was loaded / last saved, as a partial 
+    document. Changed properties are nested under `properties`, removed
+    ones are set to None, and derived fields ride along with any change.
+    Untracked sounds return the whole document. For partially fetched 
+    sounds, only fetched fields are compared and nothing counts as removed.
+    """
+    if self._clean is None:
+      return self.to_dict()
+    clean = self._clean
+    partial = self._partial
+    diff = {}
+    for k in ('uid', 'path', 'ext', 'mimetype'):
+      if partial and k not in clean:
+        continue
+      v = getattr(self, k)
+      if clean.get(k) != v:
+        diff[k] = v
+    if not (partial and 'created_at' not in clean):
+      if _date_from_store(clean.get('created_at')) != self.created_at:
+        diff['created_at'] = self.created_at
+
+    old = _stored_properties(clean)
+    props = self.properties
+    changed = {k: v for k, v in props.iteritems() if k not in old or old[k] != v}
+    if not partial:
+      for k in old:
+        if k not in props:
+          changed[k] = None
+    if changed:
+      diff['properties'] = changed
+    # a partial sound can't derive these from what it has.
+    if diff and not partial:
+      for k in DERIVED_FIELDS:
+        diff[k] = getattr(self, k)
+    return diff
+
+  def mark_clean(self, stored=None, partial=None):
+    """
+    record the stored state. `stored` is the document as it came from the
+    store, kept as-is and never modified; without it the current state is
+    copied. Cheap either way: derived fields aren't computed. `partial`
+    marks a document that only holds some of the stored fields.
+    """
+    if partial is not None:
+      self._partial = partial
+    if stored is None:
+      stored = {k: getattr(self, k) for k in ('uid', 'path', 'ext', 'mimetype', 'created_at')}
+      stored['properties'] = {k: _copy_value(v) for k, v in self.properties.iteritems()}
+    self._clean = stored
+    return self
+
+  def merge_stored(self, stored):
+    """
+    track an untracked sound against its stored document, keeping 
+    stored properties it doesn't have, as an upsert would.
+    """
+    for k, v in _stored_properties(stored).iteritems():
+      if k not in self.properties:
+        self.properties[k] = _copy_value(v)
+    self.created_at = _date_from_store(stored.get('created_at')) or self.created_at
+    self.updated_at = _date_from_store(stored.get('updated_at')) or self.updated_at
+    return self.mark_clean(stored, partial=False)
+
   def to_flat_dict(self):
     """
 
@@ -340,9 +1957,14 @@ class Sound(ConfigMixin):
 
   def to_json(self):
     """
-    Sound as json.
+    Sound as json. Dates are formatted up front so the encoder
+    never has to fall back to its `default` hook for them.
     """
-    return util.dict_to_json(self.to_dict())
+    d = self.to_dict()
+    for k in ('created_at', 'updated_at'):
+      if d[k] is not None:
+        d[k] = d[k].isoformat()
+    return util.json_serialize(d)
 
   def to_yml(self):
     """
@@ -391,11 +2013,11 @@ class Sound(ConfigMixin):
     """
     return self.fs.exists(self)
 
-  def fs_put(self, ):
+  def fs_put(self, _check=True):
     """
     Create/Replace a file 
     """
-    self.fs.put(self)
+    self.fs.put(self, _check=_check)
     return self
 
   def fs_mv(self):
@@ -413,8 +2035,7 @@ class Sound(ConfigMixin):
     Download a file 
     """
     self.path = to or self.tempfilename
-    with open(self.path, 'wb') as f:
-      f.write(self.fs.get(self))
+    self.fs.get(self, to=self.path)
     return self 
 
   def db_get(self):
@@ -474,10 +2095,216 @@ class Sound(ConfigMixin):
 
   def put(self):
     """
-    Save file + record. remove path.
-    """
-    if not self.exists():
-      self.created_at = util.date_now()
-    self.updated_at = util.date_now()
-    util.exec_async([self.fs_put, self.db_put])
+    Save file + record. The file goes first: a failed upload 
+    raises before anything is indexed, and the record picks up 
+    the checksum computed during the upload. A sound that's already
+    stored is diffed against its document, so only changed fields
+    are sent.
+    """
+    if not self.tracked:
+      stored = self.db.stored_bulk([self]).get(self.uid)
+      if stored is not None:
+        self.merge_stored(stored)
+    if self.tracked and not self.dirty:
+      return self
+    now = util.date_now()
+    if not self.tracked:
+      self.created_at = now
+      if not self.exists():
+        self.fs_put(_check=False)
+    self.updated_at = now
+    self.db_put()
     return self
+
+
+def _numpy():
+  """
+  numpy, imported on first use, or None when it isn't installed.
+  """
+  try:
+    import numpy
+  except ImportError:
+    return None
+  return numpy
+
+
+class SoundBatch(object):
+  """
+  Many sounds held column-wise. Numeric properties (`BATCH_NUMERIC`) are 
+  float arrays with NaN for missing values, `BATCH_CATEGORICAL` fields are
+  integer codes into a list of categories (-1 for missing) and any other
+  property is a sparse column of row > value. Arrays are numpy when it's
+  installed, `array.array` otherwise. Numeric columns that only ever held
+  ints come back out as ints.
+  """
+
+  def __init__(self):
+    self.size = 0
+    self.scalars = {k: [] for k in BATCH_SCALAR}
+    self.numeric = {k: [] for k in BATCH_NUMERIC}
+    self.codes = {k: [] for k in BATCH_CATEGORICAL}
+    self.categories = {k: [] for k in BATCH_CATEGORICAL}
+    self.sparse = {}
+    self._lookup = {k: {} for k in BATCH_CATEGORICAL}
+    self._floats = set()
+
+  @classmethod
+  def from_sounds(cls, sounds):
+    """
+    """
+    batch = cls()
+    for sound in sounds:
+      batch._append(sound.path, sound.created_at, sound.updated_at, sound.ext, 
+                    sound.uid, sound.mimetype, sound.properties)
+    return batch._freeze()
+
+  @classmethod
+  def from_records(cls, records):
+    """
+    Build a batch from sound dicts, nested or flat, without creating sounds.
+    """
+    batch = cls()
+    for r in records:
+      r = dict(r)
+      for k in DERIVED_FIELDS:
+        r.pop(k, None)
+      props = r.pop('properties', None) or {}
+      top = [r.pop(k, None) for k in ('path', 'created_at', 'updated_at', 'ext', 'uid', 'mimetype')]
+      r.update(props)
+      batch._append(*(top + [r]))
+    return batch._freeze()
+
+  @classmethod
+  def from_jsonl(cls, lines):
+    """
+    """
+    return cls.from_records(util.dict_from_json(l) for l in lines if l.strip())
+
+  def _append(self, path, created_at, updated_at, ext, uid, mimetype, properties):
+    """
+    add a row.
+    """
+    i = self.size
+    self.size += 1
+    for k, v in zip(BATCH_SCALAR, (uid, path, created_at, updated_at)):
+      self.scalars[k].append(v)
+    for k in BATCH_NUMERIC:
+      self.numeric[k].append(float('nan'))
+    for k in BATCH_CATEGORICAL:
+      self.codes[k].append(-1)
+    self._set_category('ext', i, ext)
+    self._set_category('mimetype', i, mimetype)
+    for k, v in properties.iteritems():
+      if k in self.numeric and v is not None:
+        try:
+          self.numeric[k][i] = float(v)
+          if isinstance(v, bool) or not isinstance(v, (int, long)):
+            self._floats.add(k)
+          continue
+        except (TypeError, ValueError):
+          pass
+      elif k in self.codes and isinstance(v, basestring):
+        self._set_category(k, i, v)
+        continue
+      self.sparse.setdefault(_intern_key(k), {})[i] = v
+
+  def _set_category(self, k, i, v):
+    """
+    """
+    if v is None:
+      return
+    code = self._lookup[k].get(v)
+    if code is None:
+      code = self._lookup[k][v] = len(self.categories[k])
+      self.categories[k].append(v)
+    self.codes[k][i] = code
+
+  def _freeze(self):
+    """
+    turn the numeric and code columns into arrays.
+    """
+    np = _numpy()
+    for k, v in self.numeric.iteritems():
+      self.numeric[k] = np.array(v, dtype='float64') if np else array.array('d', v)
+    for k, v in self.codes.iteritems():
+      self.codes[k] = np.array(v, dtype='int32') if np else array.array('i', v)
+    return self
+
+  def __len__(self):
+    return self.size
+
+  def __iter__(self):
+    return self.to_sounds()
+
+  def column(self, k):
+    """
+    A column by name: an array for numeric fields, decoded values for 
+    categorical ones and a list with None gaps for everything else.
+    """
+    if k in self.numeric:
+      return self.numeric[k]
+    if k in self.codes:
+      cats = self.categories[k]
+      return [cats[c] if c >= 0 else None for c in self.codes[k]]
+    if k in self.scalars:
+      return self.scalars[k]
+    col = self.sparse.get(k, {})
+    return [col.get(i) for i in xrange(self.size)]
+
+  def counts(self, k):
+    """
+    value > count for a categorical column.
+    """
+    codes, cats = self.codes[k], self.categories[k]
+    if not isinstance(codes, array.array):
+      n = _numpy().bincount(codes[codes >= 0], minlength=len(cats))
+      return {cats[c]: int(n[c]) for c in xrange(len(cats)) if n[c]}
+    return {cats[c]: n for c, n in Counter(c for c in codes if c >= 0).iteritems()}
+
+  def take(self, rows):
+    """
+    A new batch of the given row indexes (eg: from `np.flatnonzero(mask)`).
+    """
+    return SoundBatch.from_records(self.record(i) for i in rows)
+
+  def record(self, i):
+    """
+    one row as a sound dict.
+    """
+    r = {k: self.scalars[k][i] for k in BATCH_SCALAR}
+    props = {}
+    for k in ('ext', 'mimetype'):
+      c = self.codes[k][i]
+      r[k] = self.categories[k][c] if c >= 0 else None
+    for k in BATCH_CATEGORICAL[2:]:
+      c = self.codes[k][i]
+      if c >= 0:
+        props[k] = self.categories[k][c]
+    for k, col in self.numeric.iteritems():
+      v = col[i]
+      if v == v:
+        props[k] = float(v) if k in self._floats else int(v)
+    for k, col in self.sparse.iteritems():
+      if i in col:
+        props[k] = col[i]
+    r = {k: v for k, v in r.iteritems() if v is not None}
+    r['properties'] = props
+    return r
+
+  def to_records(self):
+    """
+    """
+    for i in xrange(self.size):
+      yield self.record(i)
+
+  def to_sounds(self):
+    """
+    """
+    for r in self.to_records():
+      yield Sound.from_store(r)
+
+  def to_jsonl(self):
+    """
+    """
+    for r in self.to_records():
+      yield util.dict_to_json(r) + "\n"
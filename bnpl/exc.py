@@ -7,4 +7,7 @@ class TransformerError(Exception):
 	pass
 
 class ExporterError(Exception):
-	pass
\ No newline at end of file
+	pass
+
+class StoreError(Exception):
+	pass
@@ -1,11 +1,13 @@
 import importlib
 import inspect
+import logging
 from collections import OrderedDict, defaultdict
 from traceback import format_exc
 
 from bnpl import util
 from bnpl.core import ConfigMixin 
-from bnpl.core import Sound
+from bnpl.core import Sound, ElasticStore
+from bnpl.core import get_client, filter_to_query
 
 
 ########################################
@@ -425,7 +427,7 @@ class Plugin(ConfigMixin):
     def _run():
       return self.run()
     
-    if self.type not in ('extractor', 'pipeline') and not self.has_data:
+    if self.type not in ('extractor', 'pipeline', 'command') and not self.has_data:
       def _run():
         return self.run(args[0]) # accepts data as first positional arg.
 
@@ -438,6 +440,10 @@ class Plugin(ConfigMixin):
       def _run():
         return self.run(self.sounds)
 
+    elif self.type == "filter":
+      def _run():
+        return self.run(self.data)
+
     return _run()
 
   def _return(self, output):
@@ -456,14 +462,41 @@ class Plugin(ConfigMixin):
 
 class Extractor(Plugin):
   """
-  Accepts parameters and returns one or sounds
+  Accepts parameters and returns one or sounds. Every match is streamed 
+  on the command line; elsewhere results come a page at a time.
   """
-  type = 'core'
+  type = 'extractor'
+  page_size = 100
 
   options = OptionSet(
-    Option('filters', type="list", items="filterstring", default=10)
+    Option('filters', type="string", 
+           help="Filter string, eg: bpm:>=120,key:Cmajor|Aminor,order:-bpm"),
+    Option('limit', type="integer", 
+           help="Return at most this many sounds instead of streaming every match."),
+    Option('page', type="integer",
+           help="Page of `limit` sounds to return, starting at 1."),
+    Option('fields', type="string",
+           help="Comma-separated fields to fetch, eg: bpm,key. Defaults to all.")
   )
 
+  def run(self):
+    """
+    Query the record store with the compiled filters.
+    """
+    db = get_client('db', ElasticStore)
+    query = filter_to_query(self.options['filters'])
+    fields = self.options['fields']
+    if fields:
+      fields = [f.strip() for f in fields.split(',') if f.strip()]
+    if self.options['limit'] or self._context != 'cli':
+      size = self.options['limit'] or self.page_size
+      query['size'] = size
+      page = self.options['page'] or 1
+      if page > 1:
+        query['from'] = (page - 1) * size
+      return db.query(query, fields=fields)
+    return db.scan(query, fields=fields)
+
 
 class Importer(Plugin):
 
@@ -472,10 +505,14 @@ class Importer(Plugin):
   Returns sounds with created / updated_at timestamps.
   """
 
-  type = 'core'
+  type = 'importer'
 
   options = OptionSet(
-    Option('pool_size', type="integer", default=10)
+    Option('pool_size', type="integer", default=10),
+    Option('batch_size', type="integer", 
+           help="Import sounds in windows of this size with bulk writes."),
+    Option('bulk_mode', type="boolean", default=False,
+           help="Disable index refreshes and replicas during the import.")
   )
 
   def run(self, sounds):
@@ -483,7 +520,24 @@ class Importer(Plugin):
     """
     if not util.list_check(sounds, strict=True):
       sounds = [sounds]
+    if self.options['bulk_mode']:
+      return self._put_bulk_mode(sounds)
+    return self._put(sounds)
+
+  def _put(self, sounds):
+    """
+    """
+    if self.options['batch_size']:
+      return self._put_batches(sounds)
     return util.exec_pooled(self._put_sound, sounds, size=self.options.pool_size)
+
+  def _put_bulk_mode(self, sounds):
+    """
+    Import with the index in bulk mode, restoring it when done.
+    """
+    with get_client('db', ElasticStore).bulk_mode():
+      for sound in self._put(sounds):
+        yield sound
   
   def _put_sound(self, sound):
     """
@@ -492,6 +546,48 @@ class Importer(Plugin):
       sound = Sound(**sound)
     return sound.put()
 
+  def _put_batches(self, sounds):
+    """
+    Import sounds window by window.
+    """
+    sounds = (s if isinstance(s, Sound) else Sound(**s) for s in sounds)
+    for window in util.list_to_chunks(sounds, n=self.options['batch_size']):
+      for sound in self._put_window(window):
+        yield sound
+
+  def _put_window(self, window):
+    """
+    Fetch the stored documents for a window with one query, upload new 
+    blobs concurrently and write every record with one bulk request. 
+    Sounds that already exist are diffed against what's stored, so only
+    changed fields are sent.
+    """
+    fs, db = window[0].fs, window[0].db
+    now = util.date_now()
+    existing = db.stored_bulk(window)
+    for sound in window:
+      stored = existing.get(sound.uid)
+      if stored is None:
+        sound.created_at = now
+      elif not sound.tracked:
+        sound.merge_stored(stored)
+      if sound.dirty:
+        sound.updated_at = now
+
+    failed = set()
+    new = [sound for sound in window if sound.uid not in existing]
+    for sound, err in fs.bulk(new, size=self.options.pool_size):
+      if err is not None:
+        logging.error("Error uploading {0}: {1}".format(sound.path, err))
+        failed.add(sound.uid)
+
+    records = [sound for sound in window if sound.uid not in failed]
+    for sound, err in db.bulk(records):
+      if err is not None:
+        logging.error("Error indexing {0}: {1}".format(sound.uid, err))
+        continue
+      yield sound
+
 class Deleter(object):
   """
 
@@ -505,6 +601,33 @@ class Deleter(object):
   type = 'deleter'
 
 
+class Command(Plugin):
+  """
+  Runs a maintenance task and returns its result.
+  """
+  type = 'command'
+
+
+class Filter(Plugin):
+  """
+  Drops sounds that don't match a filter string, in-process.
+  """
+  type = 'filter'
+
+  options = OptionSet(
+    Option('filters', type="string", required=True,
+           help="Filter string, eg: bpm:>=120,key:Cmajor|Aminor")
+  )
+
+  def run(self, data):
+    """
+    Filter raw records, skipping Sound construction for those dropped.
+    """
+    match = util.filter_to_predicate(self.options['filters'])
+    predicate = lambda r: match(r if isinstance(r, dict) else r.to_dict())
+    return util.filter_apply(predicate, data)
+
+
 class Transformer(Plugin):
   """
   Accepts a sound + parameters and returns a modified sound or one or more new sounds
@@ -543,12 +666,20 @@ class Factory(ConfigMixin):
 
   INTERNAL = [
     'Transformer', 'Exporter', 'Importer', 
-    'Extractor', 'Plugin', 'Pipeline', 'Deleter',
+    'Extractor', 'Plugin', 'Pipeline', 'Deleter', 'Filter', 'Command',
   ]
 
   def __init__(self):
     self._plugins = defaultdict(dict)
     self._factory = {}
+    self._factory['core.extractor'] = Extractor 
+    self._plugins['core.extractor']['class'] = Extractor 
+    self._plugins['core.extractor']['module'] = 'core'
+    self._plugins['core.extractor']['import_path'] = 'bnpl.Extractor'
+    self._factory['core.filter'] = Filter 
+    self._plugins['core.filter']['class'] = Filter 
+    self._plugins['core.filter']['module'] = 'core'
+    self._plugins['core.filter']['import_path'] = 'bnpl.Filter'
     self._factory['core.importer'] = Importer 
     self._plugins['core.importer']['class'] = Importer 
     self._plugins['core.importer']['module'] = 'core'
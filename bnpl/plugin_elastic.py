@@ -0,0 +1,73 @@
+from bnpl import Option, OptionSet
+from bnpl import Command
+from bnpl.core import ElasticStore, get_client
+
+
+class CreateIndex(Command):
+  """
+  Create the sound index + template, or upgrade an existing index's mapping.
+  """
+  options = OptionSet(
+    Option('upgrade', type="boolean", default=False,
+           help="Push the mapping onto an existing index.")
+  )
+
+  def run(self):
+    """
+    """
+    db = get_client('db', ElasticStore)
+    return db.create_index(upgrade=self.options['upgrade'])
+
+
+class Reindex(Command):
+  """
+  Copy the sound index into a new version and atomically swap the alias.
+  """
+  options = OptionSet(
+    Option('rederive', type="boolean", default=False,
+           help="Recompute slug, filename and url through Sound."),
+    Option('slices', type="integer", default=4),
+    Option('pool_size', type="integer", default=4)
+  )
+
+  def run(self):
+    """
+    """
+    db = get_client('db', ElasticStore)
+    return db.reindex(rederive=self.options['rederive'], 
+                      slices=self.options['slices'], 
+                      pool_size=self.options['pool_size'])
+
+
+class Facets(Command):
+  """
+  Key, chord, genre, bpm and duration counts for sounds matching a filter.
+  """
+  options = OptionSet(
+    Option('filters', type="string", 
+           help="Filter string, eg: bpm:>=120,key:Cmajor|Aminor"),
+    Option('facets', type="string",
+           help="Comma-separated facets to compute. Defaults to all.")
+  )
+
+  def run(self):
+    """
+    """
+    db = get_client('db', ElasticStore)
+    facets = self.options['facets']
+    if facets:
+      facets = [f.strip() for f in facets.split(',') if f.strip()]
+    return db.facets(self.options['filters'], facets)
+
+
+class ExpireBulkMode(Command):
+  """
+  Drop expired bulk mode leases, restoring index settings if none are left.
+  """
+  options = OptionSet()
+
+  def run(self):
+    """
+    """
+    db = get_client('db', ElasticStore)
+    return {'restored': db.expire_bulk_mode()}
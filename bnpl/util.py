@@ -6,15 +6,25 @@ import gevent.monkey
 gevent.monkey.patch_all()
 import gevent
 from gevent.pool import Pool
+from gevent.threadpool import ThreadPool
+from gevent.queue import Queue
 
 import os
 import re
 import sys
 import uuid
+import select
 import time
 import hashlib
 import json
+import zlib
+import struct
+import marshal
+import bz2
+import errno
+import shutil
 import logging
+import itertools
 import collections
 import subprocess
 import argparse 
@@ -41,47 +51,218 @@ from werkzeug.utils import secure_filename
 from tzlocal import get_localzone
 
 ##########################################
-# JSON UTILITES
+# CACHE UTILITIES
 ##########################################
 
-def json_serialize(o):
+class LRU(object):
+  """
+  A size-bounded, least recently used cache with an optional ttl.
+  """
 
+  def __init__(self, size=1024, ttl=None):
+    self.size = size
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self._items = OrderedDict()
+
+  def get(self, key, default=None):
+    """
+    get an item, marking it as recently used.
+    """
+    try:
+      value, ts = self._items.pop(key)
+    except KeyError:
+      self.misses += 1
+      return default
+    if self.ttl is not None and time.time() - ts > self.ttl:
+      self.misses += 1
+      return default
+    self._items[key] = (value, ts)
+    self.hits += 1
+    return value
+
+  def set(self, key, value):
+    """
+    add an item, evicting the least recently used if full.
+    """
+    self._items.pop(key, None)
+    self._items[key] = (value, time.time())
+    while len(self._items) > self.size:
+      self._items.popitem(last=False)
+
+  def pop(self, key):
+    """
+    drop an item.
+    """
+    return self._items.pop(key, (None, None))[0]
+
+  def clear(self):
+    """
+    drop everything.
+    """
+    self._items.clear()
+
+  def stats(self):
+    """
+    hit / miss counters.
+    """
+    total = self.hits + self.misses
+    return {
+      "size": len(self._items),
+      "hits": self.hits,
+      "misses": self.misses,
+      "hit_ratio": float(self.hits) / total if total else 0.0
+    }
+
+  def __len__(self):
+    return len(self._items)
+
+
+class Generation(object):
   """
-  obj > json
+  A generation counter shared between processes through a file. 
+  Writers `bump` it; readers call `changed` to learn whether anyone
+  wrote since they last looked, reading the file at most every 
+  `interval` seconds.
   """
 
-  class _encoder(json.JSONEncoder):
+  def __init__(self, path, interval=1):
+    self.path = path
+    self.interval = interval
+    self._value = None
+    self._checked = 0
+
+  def _read(self):
+    try:
+      with open(self.path) as f:
+        return f.read()
+    except IOError:
+      return ''
 
-    """ This encoder will serialize all entities that have a to_dict
-    method by calling that method and serializing the result.
-    Taken from: https://github.com/pudo/apikit
+  def bump(self):
+    """
+    start a new generation.
+    """
+    value = "{0:.6f}-{1}".format(time.time(), os.getpid())
+    tmp = "{0}.{1}".format(self.path, os.getpid())
+    with open(tmp, 'w') as f:
+      f.write(value)
+    os.rename(tmp, self.path)
+    self._value = value
+    self._checked = time.time()
+
+  def changed(self):
+    """
+    whether the generation moved since the last check.
     """
+    now = time.time()
+    if now - self._checked < self.interval:
+      return False
+    self._checked = now
+    value = self._read()
+    if value == self._value:
+      return False
+    first = self._value is None
+    self._value = value
+    return not first
 
-    def __init__(self, refs=False):
-      self.refs = refs
-      super(_encoder, self).__init__()
-
-    def default(self, o):
-      """
-      """
-      if isinstance(o, (date, datetime)):
-        return date_to_iso(o)
-      if isinstance(o, set):
-        return list(o)
-      if isgenerator(o):
-        return list(o)
-      if isinstance(o, Counter):
-        return dict(o)
-      if isinstance(o, RegexType):
-        return o.pattern
-      if hasattr(o, 'to_dict'):
-        return o.to_dict()
-      if hasattr(o, 'to_json'):
-        return o.to_json()
-      return json.JSONEncoder.default(self, o)
-
-  data = _encoder().encode(o)
-  return data
+
+def exec_memoize(size=1024, ttl=None):
+  """
+  Memoize a function of hashable arguments in an LRU.
+  """
+  def wrapper(f):
+    cache = LRU(size, ttl)
+
+    @wraps(f)
+    def wrapped_func(*args, **kwargs):
+      key = args
+      if kwargs:
+        key += tuple(sorted(kwargs.items()))
+      value = cache.get(key, _exec_done)
+      if value is _exec_done:
+        value = f(*args, **kwargs)
+        cache.set(key, value)
+      return value
+
+    wrapped_func.cache = cache
+    return wrapped_func
+
+  return wrapper
+
+##########################################
+# JSON UTILITES
+##########################################
+
+class _JSONEncoder(json.JSONEncoder):
+
+  """ This encoder will serialize all entities that have a to_dict
+  method by calling that method and serializing the result.
+  Taken from: https://github.com/pudo/apikit
+  """
+
+  def default(self, o):
+    """
+    """
+    return _json_default(o)
+
+def _json_default(o):
+  """
+  json for types the encoders don't know.
+  """
+  if isinstance(o, (date, datetime)):
+    return date_to_iso(o)
+  if isinstance(o, set):
+    return list(o)
+  if isgenerator(o):
+    return list(o)
+  if isinstance(o, Counter):
+    return dict(o)
+  if isinstance(o, RegexType):
+    return o.pattern
+  if hasattr(o, 'to_dict'):
+    return o.to_dict()
+  if hasattr(o, 'to_json'):
+    return o.to_json()
+  raise TypeError(repr(o) + " is not JSON serializable")
+
+_json_encoder = _JSONEncoder()
+
+def _json_fast():
+  """
+  a faster encoder, if one is installed and handles `default` the 
+  way we need. BNPL_JSON=json turns this off.
+  """
+  choice = os.getenv('BNPL_JSON', 'auto')
+  for name in ('orjson', 'ujson'):
+    if choice not in ('auto', name):
+      continue
+    try:
+      lib = __import__(name)
+      out = lib.dumps({'d': datetime(2000, 1, 1)}, default=_json_default)
+    except Exception:
+      continue
+    if isinstance(out, bytes) and not isinstance(out, str):
+      if out == b'{"d":"2000-01-01T00:00:00"}':
+        return lambda o: lib.dumps(o, default=_json_default).decode('utf-8')
+    elif out == '{"d":"2000-01-01T00:00:00"}':
+      return partial(lib.dumps, default=_json_default)
+  return None
+
+_json_dumps = _json_fast()
+
+def json_serialize(o):
+  """
+  obj > json
+  """
+  if _json_dumps is not None:
+    try:
+      return _json_dumps(o)
+    except (TypeError, OverflowError):
+      # eg: non-string keys, huge ints.
+      pass
+  return _json_encoder.encode(o)
 
 def json_deserialize(s):
   """
@@ -165,6 +346,14 @@ def string_to_uid(fingerprint=None, salt='', length=10):
   fingerprint += salt
   return hashlib.sha1(fingerprint.encode("UTF-8")).hexdigest()[:length+1]
 
+def string_size(s):
+  """
+  length of a string in bytes, as utf-8.
+  """
+  if isinstance(s, unicode):
+    return len(s.encode('utf-8'))
+  return len(s)
+
 def string_camel_case_to_slug(string, delim=STRING_SLUG_DELIMITER):
   """
   covert camel to slug case
@@ -172,9 +361,11 @@ def string_camel_case_to_slug(string, delim=STRING_SLUG_DELIMITER):
   string = re.sub('(.)([A-Z][a-z]+)',  r'\1_\2', string)
   return re.sub('([a-z0-9])([A-Z])',  r'\1_\2', string).lower().replace('_', STRING_SLUG_DELIMITER)
 
+@exec_memoize(size=16384)
 def string_to_slug(string, delim=STRING_SLUG_DELIMITER, convert_camel=True):
   """
-  slugify a string, handling camelcasing
+  slugify a string, handling camelcasing. memoized, since 
+  the same artists / albums come up over and over.
   """
   # if convert_camel:
   #   string = string_camel_case_to_slug(string, delim=delim)
@@ -626,8 +817,14 @@ def list_to_chunks(l, n=100, _exec=False):
   """
   Yield successive n-sized chunks from l.
   """
-  itr = (l[i:i+n] for i in xrange(0, len(l), n))
-  return _gen(itr, _exec)
+  def _chunks():
+    itr = iter(l)
+    while True:
+      chunk = list(itertools.islice(itr, n))
+      if not chunk:
+        break
+      yield chunk
+  return _gen(_chunks(), _exec)
 
 def list_flatten(l, _exec=False):
   """
@@ -751,6 +948,24 @@ def path_remove(p):
   """
   return os.remove(p)
 
+def path_make_dir(p):
+  """
+  Create a directory (and its parents) if it doesn't exist.
+  """
+  try:
+    os.makedirs(p)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+  return p
+
+def path_copy(src, dest):
+  """
+  Copy a file to a new path.
+  """
+  shutil.copyfile(src, dest)
+  return dest
+
 def path_make_abs(p):
   """
   make a path absolute
@@ -813,6 +1028,160 @@ def _path_guess_mimetype(path, default=MIMETYPE_DEFAULT):
   if not len(parts): return default 
   return parts[0]
 
+##########################################
+# FILE UTILITIES
+##########################################
+
+FILE_CHUNK_SIZE = 64 * 1024
+
+def file_read_chunks(f, size=FILE_CHUNK_SIZE):
+  """
+  Lazily read a file object in chunks.
+  """
+  while True:
+    chunk = f.read(size)
+    if not chunk:
+      break
+    yield chunk
+
+def file_read_parts(f, part_size, compression=None, level=None, checksum=None, 
+                    pool_size=0, chunk_size=FILE_CHUNK_SIZE):
+  """
+  Read a file object into parts of at least `part_size` bytes (the last
+  part may be smaller), compressing on the fly and feeding the raw bytes
+  to `checksum`. With a `pool_size`, blocks are compressed in parallel
+  as independent members. Memory is bounded by the part size (times the 
+  pool size).
+  """
+  if compression and pool_size:
+    chunks = compress_blocks(_file_checksum(file_read_chunks(f, part_size), checksum), 
+                             compression, level=level, pool_size=pool_size)
+  else:
+    chunks = compress_chunks(_file_checksum(file_read_chunks(f, chunk_size), checksum), 
+                             compression, level=level)
+  buf = []
+  n = 0
+  for chunk in chunks:
+    buf.append(chunk)
+    n += len(chunk)
+    if n >= part_size:
+      yield "".join(buf)
+      buf = []
+      n = 0
+  part = "".join(buf)
+  if part:
+    yield part
+
+def _file_checksum(chunks, checksum=None):
+  """
+  feed chunks to a checksum as they're read.
+  """
+  for chunk in chunks:
+    if checksum is not None:
+      checksum.update(chunk)
+    yield chunk
+
+##########################################
+# COMPRESSION UTILITIES
+##########################################
+
+COMPRESSION_LEVELS = {
+  'gz': 6,
+  'bz2': 9
+}
+
+def compress_parse(spec):
+  """
+  'codec:level' > (codec, level)
+  """
+  if not spec:
+    return None, None
+  codec, _, level = str(spec).partition(':')
+  return codec, int(level) if level else None
+
+def compress_obj(codec, level=None):
+  """
+  Get a streaming compressor (`compress` / `flush`) for a codec.
+  """
+  if level is None:
+    level = COMPRESSION_LEVELS.get(codec)
+  if codec == 'gz':
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  if codec == 'bz2':
+    return bz2.BZ2Compressor(level)
+  raise ValueError('Invalid compression type: {0}'.format(codec))
+
+def compress_block(block, codec, level=None):
+  """
+  Compress a block as a single, self-contained member.
+  """
+  z = compress_obj(codec, level)
+  return z.compress(block) + z.flush()
+
+def compress_chunks(chunks, codec=None, level=None):
+  """
+  Lazily compress an iterable of chunks as a single stream.
+  """
+  if not codec:
+    for chunk in chunks:
+      yield chunk
+    return
+  z = compress_obj(codec, level)
+  for chunk in chunks:
+    data = z.compress(chunk)
+    if data:
+      yield data
+  yield z.flush()
+
+def compress_blocks(blocks, codec, level=None, pool_size=4):
+  """
+  Compress an iterable of blocks in order on a pool of native threads. 
+  zlib and bz2 release the GIL, so blocks compress in parallel without
+  stalling the gevent hub. Outputs concatenate into a valid multi-member 
+  stream. At most `pool_size` blocks are read ahead of the consumer.
+  """
+  pool = exec_threadpool(pool_size)
+  fn = partial(compress_block, codec=codec, level=level)
+  window = collections.deque()
+  for block in blocks:
+    window.append(pool.apply_async(fn, (block,)))
+    if len(window) >= pool_size:
+      yield window.popleft().get()
+  while window:
+    yield window.popleft().get()
+
+def decompress_obj(codec):
+  """
+  Get a streaming decompressor (`decompress` / `unused_data`) for a codec.
+  """
+  if codec == 'gz':
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+  if codec == 'bz2':
+    return bz2.BZ2Decompressor()
+  raise ValueError('Invalid compression type: {0}'.format(codec))
+
+def decompress_chunks(chunks, codec=None):
+  """
+  Lazily decompress an iterable of chunks, including 
+  streams of concatenated members.
+  """
+  if not codec:
+    for chunk in chunks:
+      yield chunk
+    return
+  z = decompress_obj(codec)
+  for chunk in chunks:
+    while chunk:
+      data = z.decompress(chunk)
+      if data:
+        yield data
+      chunk = z.unused_data
+      if chunk:
+        z = decompress_obj(codec)
+  data = z.flush() if hasattr(z, 'flush') else None
+  if data:
+    yield data
+
 ##########################################
 # REGEX UTILITIES 
 ##########################################
@@ -845,7 +1214,7 @@ def regex_check(s):
 ##########################################
 # key.subkey:value (match sub-value)
 # key:=value (match, equivalent to ':')
-# key:~value (regex match)
+# key:~value (regex match against the whole value)
 # key:?value (text search)
 # key:>value (lt/gt/lte/gte than value)
 # key:value+value (match all values)
@@ -870,7 +1239,9 @@ filter_op_map = {
   '>=': 'gte',
   '<': 'lt',
   '>': 'gt',
-  '>=': 'gte',
+  '<=': 'lte',
+  '!': 'ne',
+  '!=': 'ne',
   '?': 'query',
   '~': 'regex'
 }
@@ -911,7 +1282,7 @@ def filter_parse(s):
       if not v in ("and", "or"):
         raise ValueError('Invalid compare value in filter: {0}'.format(s))
       output['compare'] = v
-      break
+      continue
 
     if k  == "order":
       output['order'].append({
@@ -927,10 +1298,135 @@ def filter_parse(s):
       })
 
   if not len(output['order']):
-    output['order'] = ["-created_at"]
+    output['order'] = [{'op': 'desc', 'key': 'created_at'}]
 
   return output
     
+def filter_normalize(s):
+  """
+  canonical form of a filter string: filters 
+  sorted and de-duplicated, ordering kept as-is.
+  """
+  clauses = [u"{0}:{1}{2}".format(f[0], f[1], f[3].strip()) for f in re_filter.findall(s or '')]
+  order = [c for c in clauses if c.startswith('order:')]
+  return ",".join(sorted(set(c for c in clauses if not c.startswith('order:'))) + order)
+
+def filter_to_predicate(s):
+  """
+  Compile a filter string into a predicate over sound records 
+  (dicts, with arbitrary keys under `properties`).
+  """
+  return _filter_compile_predicate(filter_normalize(s))
+
+def filter_apply(predicate, records):
+  """
+  Lazily filter records with a predicate, one at a time 
+  so matches go out as soon as they come in.
+  """
+  for r in records:
+    if predicate(r):
+      yield r
+
+@exec_memoize(size=512)
+def _filter_compile_predicate(s):
+  """
+  compile a normalized filter string.
+  """
+  f = filter_parse(s)
+  preds = [_filter_predicate(c) for c in f['filter']]
+  if not preds:
+    return lambda r: True
+  return _filter_combine(preds, f['compare'])
+
+def _filter_combine(preds, compare="and"):
+  """
+  combine predicates with and / or.
+  """
+  if len(preds) == 1:
+    return preds[0]
+
+  if compare == "or":
+    def _or(r):
+      for p in preds:
+        if p(r): return True
+      return False
+    return _or
+
+  def _and(r):
+    for p in preds:
+      if not p(r): return False
+    return True
+  return _and
+
+def _filter_predicate(c):
+  """
+  compile a single filter into a predicate. values are typed
+  and regexes compiled once, up front.
+  """
+  get = _filter_getter(c['key'])
+  op, val = c['op'], c['val']
+
+  # multiple values
+  if isinstance(val, dict):
+    return _filter_combine([_filter_predicate(dict(c, val=v)) for v in val['items']], 
+                           val['compare'])
+
+  # anchored at both ends, like elasticsearch's regexp query.
+  if op == 'regex':
+    rx = regex_prepare(u'(?:{0})\\Z'.format(val))
+    return lambda r: rx.match(_filter_str(get(r))) is not None
+
+  if op == 'query':
+    q = val.lower()
+    return lambda r: q in _filter_str(get(r)).lower()
+
+  num = float_prepare(val) if float_check(val) else None
+  test = {
+    'eq': lambda a, b: a == b,
+    'ne': lambda a, b: a != b,
+    'gt': lambda a, b: a > b,
+    'gte': lambda a, b: a >= b,
+    'lt': lambda a, b: a < b,
+    'lte': lambda a, b: a <= b
+  }[op]
+
+  if num is not None:
+    def _num(r):
+      try:
+        return test(float(get(r)), num)
+      except (TypeError, ValueError):
+        return op == 'ne'
+    return _num
+
+  return lambda r: test(_filter_str(get(r)), val)
+
+def _filter_getter(key):
+  """
+  look a key up at the top-level of a record, then under `properties`.
+  """
+  parts = key.split('.')
+  head, rest = parts[0], parts[1:]
+  if head == 'properties' and rest:
+    head, rest = rest[0], rest[1:]
+
+  def _get(r):
+    v = r.get(head)
+    if v is None:
+      v = (r.get('properties') or {}).get(head)
+    for p in rest:
+      v = v.get(p) if isinstance(v, dict) else None
+    return v
+  return _get
+
+def _filter_str(v):
+  """
+  """
+  if v is None:
+    return ''
+  if string_check(v):
+    return v
+  return str(v)
+
 def _filter_parse_value(s):
   """
   """
@@ -965,7 +1461,8 @@ def sys_get_platform():
 
 def sys_get_env(package='bnpl'):
   """
-
+  Config overrides from env variables named {PACKAGE}_{SECTION}_{KEY}.
+  Variables without a key (BNPL_CONFIG, BNPL_JSON) are skipped.
   """
   d = {}
   prefix = '%s_' % package
@@ -978,17 +1475,22 @@ def sys_get_env(package='bnpl'):
     if key.startswith(prefix) or package == 'all':
 
       # parse key
-      key = key.replace(prefix)
-      top = key.split('_')[0]
-      sub = "_".join(key.split('_')[1:])
+      if key.startswith(prefix):
+        key = key[len(prefix):]
+      top, _, sub = key.partition('_')
+      if not top or not sub:
+        continue
       
       # json
       if val.startswith('{'):
-        d[top][sub] = json_to_obj(val)
+        d.setdefault(top, {})[sub] = json_to_obj(val)
       
       # lists
       elif ',' in val:
-        d[top][sub] = [v.strip() for v in val.split(',') if v.strip()]
+        d.setdefault(top, {})[sub] = [v.strip() for v in val.split(',') if v.strip()]
+
+      else:
+        d.setdefault(top, {})[sub] = val
 
   return d
 
@@ -1003,7 +1505,11 @@ def sys_get_config(d=None):
   conf = {}
   for f in (f for f in path_list(d) if f.endswith('yml')):
     conf.update(dict_from_yml_file(f))
-  conf.update(sys_get_env())
+  for top, sub in sys_get_env().iteritems():
+    if isinstance(conf.get(top), dict):
+      conf[top].update(sub)
+    else:
+      conf[top] = sub
   conf['platform'] = sys_get_platform()
   return conf
 
@@ -1018,13 +1524,108 @@ def sys_read_json():
   """
   return dict_from_json(sys.stdin.read())
 
-def sys_read_jsonl():
-  """
-  """
-  for line in sys.stdin.readlines():
+def sys_read_jsonl(head=''):
+  """
+  stream jsonl from stdin a line at a time. `head` 
+  is anything already read off the stream.
+  """
+  lines = iter(sys_readline, '')
+  if head:
+    # complete lines in head stand alone; only a trailing
+    # partial line is joined with the rest of its line.
+    parts = head.split('\n')
+    rest = parts.pop()
+    if rest:
+      parts.append(rest + sys_readline())
+    lines = itertools.chain(parts, lines)
+  for line in lines:
     if not line.strip(): continue
     yield dict_from_json(line)
 
+def sys_readline():
+  """
+  read a line from stdin, first flushing pending output
+  if the read is going to block.
+  """
+  sys_stdin_wait()
+  return sys.stdin.readline()
+
+def sys_stdin_wait():
+  """
+  flush buffered output if stdin has nothing ready, so 
+  downstream stages aren't kept waiting while we are.
+  """
+  if not any(b.pending for b in _sys_buffers):
+    return
+  try:
+    ready = select.select([sys.stdin], [], [], 0)[0]
+  except Exception:
+    ready = False
+  if not ready:
+    for b in _sys_buffers:
+      b.flush()
+
+# stdout flush thresholds.
+SYS_FLUSH_BYTES = 64 * 1024
+SYS_FLUSH_SECS = 0.5
+
+_sys_buffers = []
+
+class OutputBuffer(object):
+  """
+  Bounded write buffer. Flushes once `size` bytes are pending, 
+  `interval` seconds after data first becomes pending (from a timer 
+  greenlet, so a stalled producer doesn't hold output back), before
+  stdin blocks and when closed.
+  """
+
+  def __init__(self, f, size=SYS_FLUSH_BYTES, interval=SYS_FLUSH_SECS):
+    self.f = f
+    self.size = size
+    self.interval = interval
+    self.pending = 0
+    self._chunks = []
+    self._flushed = time.time()
+    self._timer = None
+
+  def __enter__(self):
+    _sys_buffers.append(self)
+    return self
+
+  def __exit__(self, *args):
+    _sys_buffers.remove(self)
+    self.flush()
+
+  def write(self, s):
+    """
+    """
+    self._chunks.append(s)
+    self.pending += len(s)
+    if self.pending >= self.size or time.time() - self._flushed >= self.interval:
+      self.flush()
+    elif not self._timer:
+      self._timer = gevent.spawn_later(self.interval, self._expire)
+
+  def _expire(self):
+    """
+    timer callback: flush whatever has been waiting `interval` seconds.
+    """
+    self._timer = None
+    self.flush()
+
+  def flush(self):
+    """
+    """
+    if self._timer:
+      self._timer.kill(block=False)
+    self._timer = None
+    if self._chunks:
+      self.f.write(''.join(self._chunks))
+      self._chunks = []
+      self.pending = 0
+    self.f.flush()
+    self._flushed = time.time()
+
 def sys_write_yml(o):
   """
   put yml to stdout
@@ -1041,13 +1642,14 @@ def sys_write_json(o):
 
 def sys_write_jsonl(o):
   """
-  put json to stdout
+  put json to stdout, streaming.
   """
-  if list_check(o):
-    for oo in o:
-      sys.stdout.write(dict_to_json(oo) + "\n")
-    return
-  sys.stdout.write(dict_to_json(o) + "\n")
+  with OutputBuffer(sys.stdout) as out:
+    if list_check(o):
+      for oo in o:
+        out.write(dict_to_json(oo) + "\n")
+      return
+    out.write(dict_to_json(o) + "\n")
   return
 
 def sys_exec(cmd):
@@ -1142,17 +1744,52 @@ def cli_read_options(prog='bnpl'):
     opts[key] = value
   return opts
 
+_cli_binary_input = False
+
 def cli_read_data():
   """
-  alias
-  """
-  return sys_read_jsonl()
-
+  stream records from stdin: binary if the stream starts 
+  with `BIN_MAGIC`, jsonl otherwise. Nothing is read
+  until the first record is asked for.
+  """
+  global _cli_binary_input
+  head = sys.stdin.read(len(BIN_MAGIC))
+  if head == BIN_MAGIC:
+    _cli_binary_input = True
+    records = bin_read(sys.stdin)
+  else:
+    records = sys_read_jsonl(head)
+  for record in records:
+    yield record
+
+def cli_format():
+  """
+  output format for stdout. BNPL_CLI_FORMAT is `binary`, `jsonl` or 
+  `auto` (the default): binary if binary came in. terminals always 
+  get jsonl.
+  """
+  if sys.stdout.isatty():
+    return 'jsonl'
+  fmt = os.getenv('BNPL_CLI_FORMAT', 'auto')
+  if fmt == 'auto':
+    return 'binary' if _cli_binary_input else 'jsonl'
+  return fmt
 
 def cli_write_data(output):
   """
-  alias
+  write records to stdout in `cli_format`. The format is picked 
+  once the first record is out, after any input has been read.
   """
+  if list_check(output):
+    output = iter(output)
+    first = next(output, _exec_done)
+    if first is _exec_done:
+      output = (o for o in ())
+    else:
+      output = itertools.chain([first], output)
+      output = (o for o in output)
+  if cli_format() == 'binary':
+    return bin_write(output, sys.stdout)
   return sys_write_jsonl(output)
 
 def _cli_parse_arg_string(arg_string):
@@ -1198,6 +1835,72 @@ def _cli_arg_prepare(value):
       raise err
   return value
 
+##########################################
+# BINARY UTILITIES
+##########################################
+# A stream of length-prefixed marshal records after a magic header,
+# for bnpl stages talking to each other. Blobs like fingerprints go
+# through as raw strings instead of being escaped / unescaped as json.
+# marshal isn't stable across python versions; every stage in a pipe
+# runs the same interpreter.
+
+BIN_MAGIC = 'BNPL\x01'
+BIN_LENGTH = struct.Struct('>I')
+
+def bin_encode(o):
+  """
+  obj > length-prefixed record
+  """
+  if hasattr(o, 'to_dict'):
+    o = _bin_dates(o.to_dict())
+  try:
+    data = marshal.dumps(o, 2)
+  except ValueError:
+    try:
+      data = marshal.dumps(_bin_dates(o), 2)
+    except ValueError:
+      data = marshal.dumps(json_deserialize(json_serialize(o)), 2)
+  return BIN_LENGTH.pack(len(data)) + data
+
+def _bin_dates(o):
+  """
+  format top-level dates, the usual reason marshal refuses a record.
+  """
+  if not isinstance(o, dict):
+    return o
+  return {k: date_to_iso(v) if isinstance(v, (date, datetime)) else v 
+          for k, v in o.iteritems()}
+
+def bin_read(f):
+  """
+  yield records from a binary stream, after the magic header.
+  """
+  while True:
+    if f is sys.stdin:
+      sys_stdin_wait()
+    n = f.read(BIN_LENGTH.size)
+    if not n:
+      return
+    if len(n) < BIN_LENGTH.size:
+      raise ValueError('Truncated binary record header.')
+    size = BIN_LENGTH.unpack(n)[0]
+    data = f.read(size)
+    if len(data) < size:
+      raise ValueError('Truncated binary record.')
+    yield marshal.loads(data)
+
+def bin_write(o, f):
+  """
+  write a binary stream of one or more records.
+  """
+  with OutputBuffer(f) as out:
+    out.write(BIN_MAGIC)
+    if list_check(o):
+      for oo in o:
+        out.write(bin_encode(oo))
+      return
+    out.write(bin_encode(o))
+
 ##########################################
 # API UTILITIES
 ##########################################
@@ -1293,17 +1996,83 @@ def error_tb():
 # EXECUTION UTILITIES
 ##########################################
 
-def exec_pooled(fn, itr, size=10, _exec=False, **kwargs):
+def exec_pooled(fn, itr, size=10, _exec=False, _stream=False, _maxsize=None, **kwargs):
   """
-  Pooled execution
+  Pooled execution. Returns the results in order once they are 
+  all done. With `_stream`, yields them as they finish instead, 
+  `_maxsize` bounding how many wait to be consumed.
   """
   p = Pool(size)
   fn = partial(fn, **kwargs)
-  return map(fn, itr)
-  # items = p.imap_unordered(fn, itr)
-  # if _exec:
-  #   items = list(items)
-  # return items
+  if not _stream:
+    return p.map(fn, itr)
+  if _maxsize:
+    items = p.imap_unordered(fn, itr, maxsize=_maxsize)
+  else:
+    items = p.imap_unordered(fn, itr)
+  return (i for i in items)
+
+_threadpools = {}
+
+def exec_threadpool(size=4):
+  """
+  A shared pool of native threads per process, for
+  cpu bound work that releases the GIL.
+  """
+  key = (os.getpid(), size)
+  if key not in _threadpools:
+    _threadpools[key] = ThreadPool(size)
+  return _threadpools[key]
+
+_exec_done = object()
+
+def exec_prefetch(itr):
+  """
+  Iterate while fetching the next item in the background. 
+  Stopping early cancels the pending fetch.
+  """
+  itr = iter(itr)
+  nxt = gevent.spawn(next, itr, _exec_done)
+  try:
+    while True:
+      item = nxt.get()
+      if item is _exec_done:
+        break
+      nxt = gevent.spawn(next, itr, _exec_done)
+      yield item
+  finally:
+    nxt.kill()
+    if hasattr(itr, 'close'):
+      itr.close()
+
+def exec_merge(itrs, maxsize=None):
+  """
+  Consume several iterables concurrently, yielding items as 
+  they arrive. Errors are re-raised in the consumer.
+  """
+  q = Queue(maxsize or len(itrs) * 2)
+
+  def _consume(itr):
+    try:
+      for item in itr:
+        q.put((item, None))
+      q.put((_exec_done, None))
+    except Exception as e:
+      q.put((_exec_done, e))
+
+  greenlets = [gevent.spawn(_consume, itr) for itr in itrs]
+  remaining = len(greenlets)
+  try:
+    while remaining:
+      item, err = q.get()
+      if err is not None:
+        raise err
+      if item is _exec_done:
+        remaining -= 1
+        continue
+      yield item
+  finally:
+    gevent.killall(greenlets)
 
 def exec_async(funcs=[], **kwargs):
   """
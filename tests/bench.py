@@ -0,0 +1,165 @@
+"""
+Micro benchmarks. Run with `make bench`; set BNPL_BENCH_N to change the
+number of records.
+"""
+import os
+import gc
+import sys
+import json
+import pickle
+import time
+from datetime import date, datetime
+
+from bnpl import util
+from bnpl.core import Sound, ConfigMixin, DERIVED_FIELDS
+
+
+N = int(os.getenv('BNPL_BENCH_N', 100000))
+
+
+class LegacySound(ConfigMixin):
+  """
+  Sound's constructor as it was before __slots__ and key interning:
+  a plain instance __dict__ and a properties dict per sound.
+  """
+
+  def  __init__(self, **properties):
+    self.path = properties.pop('path','')
+    self.created_at = util.date_from_any(properties.pop('created_at', None))
+    self.updated_at = util.date_from_any(properties.pop('updated_at', None))
+    self.ext = properties.pop('ext', util.path_get_ext(self.path))
+    self.uid = properties.pop('uid', util.string_to_uid(self.path))
+    self.mimetype = properties.pop('mimetype', self._get_mimetype(self.path))
+    self._set_properties(properties)
+    self._clean = None
+    self._derived = {}
+
+  def _get_mimetype(self, path):
+    return util.path_get_mimetype(path, 
+                                  lookup=self.config['mimetypes']['lookup'])
+
+  def _set_properties(self, properties):
+    for k in DERIVED_FIELDS:
+      properties.pop(k, None)
+    _properties = properties.pop('properties', {})
+    self.properties = properties
+    self.properties.update(_properties)
+
+
+def records(n=N):
+  """
+  sound records as they come off a json pipe.
+  """
+  for i in xrange(n):
+    yield json.loads(json.dumps({
+      'path': '/music/{0}/{1}.mp3'.format(i % 500, i),
+      'uid': '{0:032x}'.format(i),
+      'ext': 'mp3',
+      'mimetype': 'audio/mpeg',
+      'created_at': '2016-10-01T12:00:00+00:00',
+      'updated_at': '2016-10-02T12:00:00+00:00',
+      'properties': {
+        'artist': 'Artist {0}'.format(i % 500),
+        'album': 'Album {0}'.format(i % 2000),
+        'title': 'Track {0}'.format(i),
+        'genre': 'house',
+        'bpm': 120 + i % 10,
+        'key': 'Aminor',
+        'duration': 312.5
+      }
+    }))
+
+
+def sizeof(obj, seen):
+  """
+  bytes held by an object, not counting anything in `seen`.
+  """
+  if id(obj) in seen:
+    return 0
+  seen.add(id(obj))
+  n = sys.getsizeof(obj)
+  if isinstance(obj, dict):
+    n += sum(sizeof(k, seen) + sizeof(v, seen) for k, v in obj.iteritems())
+  elif isinstance(obj, (list, tuple)):
+    n += sum(sizeof(v, seen) for v in obj)
+  if hasattr(obj, '__dict__'):
+    n += sizeof(obj.__dict__, seen)
+  for k in getattr(type(obj), '__slots__', ()):
+    n += sizeof(getattr(obj, k, None), seen)
+  return n
+
+
+def report(name, n, secs, unit='records'):
+  """
+  """
+  print('{0:<32} {1:>12,.0f} {2}/s'.format(name, n / secs, unit))
+
+
+SOUND_FIELDS = ('path', 'created_at', 'updated_at', 'ext', 'uid', 'mimetype', 'properties')
+
+def check_pickle(cls, r):
+  """
+  sounds must survive a pickle round trip, with any protocol.
+  """
+  sound = cls(**dict(r))
+  for protocol in xrange(pickle.HIGHEST_PROTOCOL + 1):
+    copy = pickle.loads(pickle.dumps(sound, protocol))
+    for k in SOUND_FIELDS:
+      assert getattr(copy, k) == getattr(sound, k), \
+        '{0}.{1} changed in a protocol {2} pickle'.format(cls.__name__, k, protocol)
+
+
+def bench_sound():
+  """
+  construction time and memory per sound, before and after slotting.
+  """
+  data = list(records())
+  for cls in (LegacySound, Sound):
+    check_pickle(cls, data[0])
+    gc.collect()
+    start = time.time()
+    sounds = [cls(**dict(r)) for r in data]
+    report('{0}()'.format(cls.__name__), len(sounds), time.time() - start)
+    seen = set()
+    total = sum(sizeof(s, seen) for s in sounds)
+    print('{0:<32} {1:>12,.0f} bytes/sound'.format(cls.__name__, float(total) / len(sounds)))
+    del sounds
+
+
+def legacy_json_serialize(o):
+  """
+  util.json_serialize as it was: a new encoder class per call.
+  """
+  class _encoder(json.JSONEncoder):
+    def default(self, o):
+      if isinstance(o, (date, datetime)):
+        return util.date_to_iso(o)
+      if hasattr(o, 'to_dict'):
+        return o.to_dict()
+      return json.JSONEncoder.default(self, o)
+  return _encoder().encode(o)
+
+
+def bench_json():
+  """
+  records / second through the json encoders.
+  """
+  sounds = [Sound(**r) for r in records()]
+  dicts = [s.to_dict() for s in sounds]
+  for name, fn, items in [
+    ('json_serialize (legacy)', legacy_json_serialize, dicts),
+    ('json_serialize', util.json_serialize, dicts),
+    ('Sound.to_json (legacy)', lambda s: legacy_json_serialize(s.to_dict()), sounds),
+    ('Sound.to_json', lambda s: s.to_json(), sounds)
+  ]:
+    start = time.time()
+    for i in items:
+      fn(i)
+    report(name, len(items), time.time() - start)
+
+
+BENCHMARKS = [bench_sound, bench_json]
+
+if __name__ == '__main__':
+  for bench in BENCHMARKS:
+    bench()
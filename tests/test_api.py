@@ -0,0 +1,40 @@
+"""
+API tests. Like test_pipeline.sh these run against the configured
+elasticsearch: `python -m unittest discover tests`.
+"""
+import json
+import unittest
+
+from bnpl import util
+from bnpl.api import app
+from bnpl.core import Sound, ElasticStore, get_client
+
+
+class TestGetSound(unittest.TestCase):
+
+  def setUp(self):
+    self.client = app.test_client()
+    self.db = get_client('db', ElasticStore)
+    self.sound = Sound.from_store({
+      'path': '/music/test/{0}.mp3'.format(util.ts_now()),
+      'properties': {'artist': 'Test'}
+    })
+    self.db.put(self.sound)
+
+  def tearDown(self):
+    self.db.rm(self.sound)
+
+  def test_found(self):
+    res = self.client.get('/api/sounds/{0}.mp3'.format(self.sound.uid))
+    self.assertEqual(res.status_code, 200)
+    data = json.loads(res.data)
+    self.assertEqual(data['uid'], self.sound.uid)
+    self.assertEqual(data['properties']['artist'], 'Test')
+
+  def test_not_found(self):
+    res = self.client.get('/api/sounds/doesnotexist.mp3')
+    self.assertEqual(res.status_code, 404)
+
+
+if __name__ == '__main__':
+  unittest.main()
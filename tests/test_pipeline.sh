@@ -3,4 +3,10 @@
 bnpl file.directory --path='tests/fixtures/' |\
 	bnpl fpcalc.uid |\
 	bnpl taglib.get_tags --tags=artist,genre,title|\
-	bnpl core.importer
\ No newline at end of file
+	bnpl core.importer
+
+# re-import the same, now unchanged, sounds in batches.
+bnpl file.directory --path='tests/fixtures/' |\
+	bnpl fpcalc.uid |\
+	bnpl taglib.get_tags --tags=artist,genre,title|\
+	bnpl core.importer --batch_size=10